@@ -0,0 +1,179 @@
+"""Benchmark update_imports on a generated package tree.
+
+Generates a synthetic project of configurable size, then times each phase of
+updating its imports for some moves: discovering files, reading them, the
+pre-filter, parsing, transforming, dumping, verifying and writing, as recorded
+by the same code a real run uses. Prints the results as JSON so they can be saved and compared across commits, eg
+
+    python benchmarks/bench_update_imports.py --packages 20 --modules 50 > before.json
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import json
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+from collections import Counter
+
+import update_imports
+from update_imports import (ModuleResolver, MoveIndex, RunStats, _process_file, _unique_paths, default_roots, have_redbaron, move_heads,
+                            parse_moves, recurse)
+
+
+def main():
+    args = parse_args()
+    if args.engine == 'redbaron' and not have_redbaron():
+        sys.exit("error: the redbaron engine needs redbaron, which isn't installed")
+    runs = []
+    for _ in range(args.repeat):
+        root = tempfile.mkdtemp(prefix='bench_update_imports_')
+        try:
+            moves = generate_tree(root, args)
+            if args.verify:
+                # Moved first, like a real run, or every update would fail.
+                for old, new in moves:
+                    os.rename(os.path.join(root, old.full.replace('.', '/') + '.py'), os.path.join(root, new.full.replace('.', '/') + '.py'))
+            runs.append(run(root, moves, args))
+        finally:
+            shutil.rmtree(root)
+    result = {
+        'config': vars(args),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'runs': runs,
+        'best': min(runs, key=lambda r: r['total']),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", help="number of top level packages (default 10)", type=int, default=10)
+    parser.add_argument("--subpackages", help="number of subpackages in each package (default 2)", type=int, default=2)
+    parser.add_argument("--modules", help="number of modules in each (sub)package (default 10)", type=int, default=10)
+    parser.add_argument("--imports", help="number of imports in each module (default 10)", type=int, default=10)
+    parser.add_argument("--relative", help="fraction of imports that are relative (default 0.3)", type=float, default=0.3)
+    parser.add_argument("--lines", help="number of lines of filler code in each module (default 100)", type=int, default=100)
+    parser.add_argument("--moves", help="number of modules to move (default 1)", type=int, default=1)
+    parser.add_argument("--engine", help="engine to benchmark (default fast)", choices=['fast', 'redbaron'], default='fast')
+    parser.add_argument("--large-file", help="only parse the import statements of files bigger than this many KB (default 1024)",
+                        type=int, default=1024, metavar="KB")
+    parser.add_argument("--verify", help="check each file's new code before writing it, like update_imports.py --verify", action="store_true")
+    parser.add_argument("--repeat", help="number of times to generate a tree and run on it (default 1)", type=int, default=1)
+    parser.add_argument("--seed", help="random seed (default 0)", type=int, default=0)
+    return parser.parse_args()
+
+
+def generate_tree(root, args):
+    """Generate a project in root according to args and return moves of some
+    of its modules to new names."""
+    rand = random.Random(args.seed)
+    modules = []
+    for p in range(args.packages):
+        pkgs = ['pkg%d' % p] + ['pkg%d.sub%d' % (p, s) for s in range(args.subpackages)]
+        for pkg in pkgs:
+            modules.extend('%s.mod%d' % (pkg, m) for m in range(args.modules))
+
+    for pkg in set(mod.rsplit('.', 1)[0] for mod in modules):
+        write(root, pkg.replace('.', '/') + '/__init__.py', '')
+    for mod in modules:
+        lines = []
+        for _ in range(args.imports):
+            target = rand.choice(modules)
+            tmod, tname = target.rsplit('.', 1)
+            if rand.random() < args.relative and tmod.split('.')[0] == mod.split('.')[0]:
+                lines.append('from %s import %s' % (relative(mod, tmod), tname))
+            elif rand.random() < 0.5:
+                lines.append('from %s import %s' % (tmod, tname))
+            else:
+                lines.append('import %s' % target)
+        lines.append('')
+        for i in range(args.lines // 4):
+            lines.extend([
+                'def func%d(a, b=%d):' % (i, i),
+                '    """Filler."""',
+                '    return [x * b for x in range(a) if x %% %d]' % (i + 2),
+                '',
+            ])
+        write(root, mod.replace('.', '/') + '.py', '\n'.join(lines) + '\n')
+
+    moved = rand.sample(modules, min(args.moves, len(modules)))
+    return parse_moves([(mod, mod + '_moved') for mod in moved])
+
+
+def relative(mod, target):
+    """Return target as imported relatively from module mod."""
+    here = mod.split('.')[:-1]
+    there = target.split('.')
+    common = 0
+    while common < min(len(here), len(there)) and here[common] == there[common]:
+        common += 1
+    return '.' * (len(here) - common + 1) + '.'.join(there[common:])
+
+
+def write(root, path, code):
+    path = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(code)
+
+
+def run(root, moves, args):
+    """Update imports in root for moves, one file at a time with the same
+    per-file code update_imports() runs, timing each phase with its Stats."""
+    stats = RunStats(slowest=0)
+    statuses = Counter()
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        moves = MoveIndex(moves)
+        heads = move_heads(moves)
+        verify = ModuleResolver(default_roots(['.'])) if args.verify else None
+        paths = list(_unique_paths(recurse('./'), stats))
+        for path in paths:
+            res = _process_file(path, moves, heads, engine=args.engine, large_file=args.large_file * 1024, verify=verify)
+            stats.add(res)
+            statuses[res.status] += 1
+    finally:
+        os.chdir(cwd)
+    total = sum(stats.times.values())
+    return {
+        'files': len(paths),
+        'parsed': len(paths) - statuses['skipped'],
+        'modified': statuses['modified'],
+        'errors': statuses['error'],
+        'imports': stats.imports,
+        'edits': stats.edits,
+        'total': total,
+        'files_per_sec': len(paths) / total if total else None,
+        'phases': stats.times,
+    }
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024 # bytes there, kB elsewhere
+    return rss
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(update_imports.__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
@@ -12,9 +12,13 @@ setup(name='refactor',
       #   mkvirtualenv venv
       #   pip install redbaron
       #   pip freeze | grep == | grep -v refactor | sort
-      install_requires=[
-          'appdirs==1.4.3',
-          'baron==0.6.6',
-          'redbaron==0.6.3',
-          'rply==0.7.4',
-      ])
+      # RedBaron is only needed for --engine=redbaron and as a fallback for
+      # code the stdlib can't parse, eg Python 2.
+      extras_require={
+          'redbaron': [
+              'appdirs==1.4.3',
+              'baron==0.6.6',
+              'redbaron==0.6.3',
+              'rply==0.7.4',
+          ],
+      })
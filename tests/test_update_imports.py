@@ -1,19 +1,39 @@
+import ast as pyast
+import io
+import json
 import os
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from unittest import mock
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import unittest
 
 from redbaron import RedBaron
 
-from update_imports import abs_mod_path, parse_moves, update_imports_ast
+from update_imports import (CACHE_VERSION, FileResult, ImportCache, ImportGraph, ImportServer, ImportUpdater, Journal, ModuleResolver, MoveIndex, PathScanner, RunStats, Stats, _process_file,
+                            _recycling_imap, abs_mod_path, check_moves, default_roots, find_import_nodes, git_changed, load_moves_file, main, may_need_update, move_heads, parse_args, parse_moves,
+                            recurse, scan_import_nodes, update_imports, update_imports_ast, update_imports_code, update_imports_file)
+
+
+def updated_code(engine, path, code, moves):
+    if engine == 'fast':
+        return update_imports_code(path, code, moves)[0]
+    ast = RedBaron(code)
+    update_imports_ast(path, ast, moves)
+    return ast.dumps()
 
 
 class TestAbsFromImport(unittest.TestCase):
+    engine = 'redbaron'
+
     def assert_updated_imports(self, old_code, moves, new_code):
-        ast = RedBaron(old_code)
-        update_imports_ast('not-used.py', ast, parse_moves(moves))
-        self.assertEqual(ast.dumps(), new_code)
+        self.assertEqual(updated_code(self.engine, 'not-used.py', old_code, parse_moves(moves)), new_code)
 
     def test_rename_rhs(self):
         self.assert_updated_imports(
@@ -43,14 +63,91 @@ class TestAbsFromImport(unittest.TestCase):
             'from pkg1 import mod2\nfrom pkg2 import mod1\n'
         )
 
-    # TODO
-    # def test_merge_rhs(self):
-    #     self.assert_updated_imports(
-    #         'from pkg1 import utils, code',
-    #         [('pkg1.utils', 'pkg1.code')],
-    #         'from pkg1 import code'
-    #     )
-    #     # TODO test that it outputs a warning that anything referencing utils will break
+    def test_star(self):
+        self.assert_updated_imports(
+            'from pkg1 import *',
+            [('pkg1', 'pkg2')],
+            'from pkg2 import *'
+        )
+
+    def test_star_unrelated(self):
+        self.assert_updated_imports(
+            'from pkg3 import *\nfrom pkg1 import utils\n',
+            [('pkg1.utils', 'pkg1.stuff')],
+            'from pkg3 import *\nfrom pkg1 import stuff as utils\n'
+        )
+
+    def test_parenthesized(self):
+        self.assert_updated_imports(
+            'from pkg1 import (a, b)',
+            [('pkg1', 'pkg2')],
+            'from pkg2 import (a, b)'
+        )
+
+    def test_parenthesized_rename_rhs(self):
+        self.assert_updated_imports(
+            'from pkg1 import (a, b)',
+            [('pkg1.b', 'pkg1.c')],
+            'from pkg1 import (a, c as b)'
+        )
+
+    def test_parenthesized_split(self):
+        self.assert_updated_imports(
+            'from pkg2 import (x)\nfrom pkg1 import (a, b)\n',
+            [('pkg1.a', 'pkg2.a'), ('pkg1.b', 'pkg3.b')],
+            'from pkg2 import (x, a)\nfrom pkg3 import b\n'
+        )
+
+    def test_merge_rhs(self):
+        with self.assertLogs(level='WARNING') as logs:
+            self.assert_updated_imports(
+                'from pkg1 import utils, code',
+                [('pkg1.utils', 'pkg1.code')],
+                'from pkg1 import code'
+            )
+        self.assertIn("update references to utils", logs.output[0])
+
+    def test_merge_into_existing_statement(self):
+        self.assert_updated_imports(
+            'from pkg2 import stuff\nfrom pkg1 import mod1, mod2\n',
+            [('pkg1.mod1', 'pkg2.mod1')],
+            'from pkg2 import stuff, mod1\nfrom pkg1 import mod2\n'
+        )
+
+    def test_merge_whole_statement(self):
+        self.assert_updated_imports(
+            'from pkg2 import stuff\nfrom pkg1 import mod1 as m\nx = 1\n',
+            [('pkg1.mod1', 'pkg2.mod1')],
+            'from pkg2 import stuff, mod1 as m\nx = 1\n'
+        )
+
+    def test_merge_into_statement_followed_by_semicolon(self):
+        self.assert_updated_imports(
+            'from pkg2 import z; x = 1\nfrom pkg1 import a\n',
+            [('pkg1.a', 'pkg2.a')],
+            'from pkg2 import z, a; x = 1\n'
+        )
+
+    def test_merge_into_statement_followed_by_comment(self):
+        self.assert_updated_imports(
+            'from pkg2 import z  # keep\nfrom pkg1 import a\n',
+            [('pkg1.a', 'pkg2.a')],
+            'from pkg2 import z, a  # keep\n'
+        )
+
+    def test_merge_already_imported(self):
+        self.assert_updated_imports(
+            'from pkg2 import mod1, stuff\nfrom pkg1 import mod1\n',
+            [('pkg1.mod1', 'pkg2.mod1')],
+            'from pkg2 import mod1, stuff\n'
+        )
+
+    def test_merge_only_earlier_top_level_statements(self):
+        self.assert_updated_imports(
+            'from pkg1 import mod1\nfrom pkg2 import stuff\ndef f():\n    from pkg2 import other\n    from pkg1 import mod2\n',
+            [('pkg1.mod1', 'pkg2.mod1'), ('pkg1.mod2', 'pkg2.mod2')],
+            'from pkg2 import mod1\nfrom pkg2 import stuff\ndef f():\n    from pkg2 import other\n    from pkg2 import mod2\n'
+        )
 
     def test_rename_lhs(self):
         self.assert_updated_imports(
@@ -200,11 +297,15 @@ class TestAbsFromImport(unittest.TestCase):
         )
 
 
+class TestAbsFromImportFast(TestAbsFromImport):
+    engine = 'fast'
+
+
 class TestRelFromImport(unittest.TestCase):
+    engine = 'redbaron'
+
     def assert_updated_imports(self, mod_path, old_code, moves, new_code):
-        ast = RedBaron(old_code)
-        update_imports_ast(mod_path, ast, parse_moves(moves))
-        self.assertEqual(ast.dumps(), new_code)
+        self.assertEqual(updated_code(self.engine, mod_path, old_code, parse_moves(moves)), new_code)
 
     def test_rename_pkg_containing_rel_import(self):
         self.assert_updated_imports(
@@ -255,11 +356,15 @@ class TestRelFromImport(unittest.TestCase):
         )
 
 
+class TestRelFromImportFast(TestRelFromImport):
+    engine = 'fast'
+
+
 class TestPlainImport(unittest.TestCase):
+    engine = 'redbaron'
+
     def assert_updated_imports(self, old_code, moves, new_code):
-        ast = RedBaron(old_code)
-        update_imports_ast('not-used.py', ast, parse_moves(moves))
-        self.assertEqual(ast.dumps(), new_code)
+        self.assertEqual(updated_code(self.engine, 'not-used.py', old_code, parse_moves(moves)), new_code)
 
     def test_update_single(self):
         self.assert_updated_imports(
@@ -358,6 +463,337 @@ class TestPlainImport(unittest.TestCase):
         )
         # TODO assert warning
 
+    def test_update_references(self):
+        self.assert_updated_imports(
+            'import x.y\nx.y.f(x.y.g)\nclass A(x.y.z.Base):\n    v = x.y[0].w\n',
+            [('x', 'api')],
+            'import api.y\napi.y.f(api.y.g)\nclass A(api.y.z.Base):\n    v = api.y[0].w\n'
+        )
+
+    def test_update_references_longer(self):
+        self.assert_updated_imports(
+            'import x.y\nvalue = x.y.f()\n',
+            [('x.y', 'api.sub.y')],
+            'import api.sub.y\nvalue = api.sub.y.f()\n'
+        )
+
+    def test_update_references_shorter(self):
+        self.assert_updated_imports(
+            'import x.y\nmod = x.y\nvalue = x.y.f()\n',
+            [('x.y', 'api')],
+            'import api\nmod = api\nvalue = api.f()\n'
+        )
+
+    def test_update_references_only_moved(self):
+        self.assert_updated_imports(
+            'import x.y\nimport x.z\nx.z.f()\nx.y.f()\n',
+            [('x.y', 'q.y')],
+            'import q.y\nimport x.z\nx.z.f()\nq.y.f()\n'
+        )
+
+    def test_references_with_as_unchanged(self):
+        self.assert_updated_imports(
+            'import x.y as foo\nfoo.f()\nimport z\nz.f()\n',
+            [('x', 'api'), ('z', 'api2')],
+            'import api.y as foo\nfoo.f()\nimport api2 as z\nz.f()\n'
+        )
+
+    def test_unimported_reference_unchanged(self):
+        with self.assertLogs(level='WARNING') as logs:
+            self.assert_updated_imports(
+                'import x.y\nx.other.f()\n',
+                [('x.y', 'api.y')],
+                'import api.y\nx.other.f()\n'
+            )
+        self.assertIn("can't update x.other.f", logs.output[0])
+
+    def test_shadowed_reference_unchanged(self):
+        with self.assertLogs(level='WARNING') as logs:
+            self.assert_updated_imports(
+                'import pkg1.a\ndef f(pkg1):\n    return pkg1.a\nfor x, pkg1 in y:\n    pkg1.a\n',
+                [('pkg1.a', 'pkg2.a')],
+                'import pkg2.a\ndef f(pkg1):\n    return pkg1.a\nfor x, pkg1 in y:\n    pkg1.a\n'
+            )
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("can't update pkg1.a since pkg1 is also bound", logs.output[0])
+
+
+class TestPlainImportFast(TestPlainImport):
+    engine = 'fast'
+
+
+class TestMultipleMoves(unittest.TestCase):
+    engine = 'redbaron'
+
+    def assert_updated_imports(self, old_code, moves, new_code):
+        self.assertEqual(updated_code(self.engine, 'not-used.py', old_code, parse_moves(moves)), new_code)
+
+    def test_rhs_to_different_modules(self):
+        self.assert_updated_imports(
+            'from pkg1 import a, b, c',
+            [('pkg1.a', 'pkg2.a'), ('pkg1.b', 'pkg3.b')],
+            'from pkg1 import c\nfrom pkg2 import a\nfrom pkg3 import b\n'
+        )
+
+    def test_rhs_to_same_module(self):
+        self.assert_updated_imports(
+            'from pkg1 import a, b, c',
+            [('pkg1.a', 'pkg2.a'), ('pkg1.b', 'pkg2.bee')],
+            'from pkg1 import c\nfrom pkg2 import a, bee as b\n'
+        )
+
+    def test_longest_lhs_wins(self):
+        self.assert_updated_imports(
+            'from pkg1.utils import api',
+            [('pkg1', 'pkg2'), ('pkg1.utils', 'pkg3')],
+            'from pkg3 import api'
+        )
+
+    def test_longest_plain_import_wins(self):
+        self.assert_updated_imports(
+            'import pkg1.utils, pkg1.other',
+            [('pkg1', 'pkg2'), ('pkg1.utils', 'pkg3.utils')],
+            'import pkg3.utils, pkg2.other'
+        )
+
+    def test_rhs_and_lhs(self):
+        self.assert_updated_imports(
+            'from pkg1 import utils, code',
+            [('pkg1.utils', 'pkg1.stuff'), ('pkg1', 'pkg2')],
+            'from pkg2 import code\nfrom pkg1 import stuff as utils\n'
+        )
+
+    def test_merge_from_several_statements(self):
+        self.assert_updated_imports(
+            'from pkg3 import c\nfrom pkg1 import a\nfrom pkg2 import b, d\n',
+            [('pkg1.a', 'pkg3.a'), ('pkg2.b', 'pkg3.bee')],
+            'from pkg3 import c, a, bee as b\nfrom pkg2 import d\n'
+        )
+
+    def test_swap(self):
+        self.assert_updated_imports(
+            'import a, b',
+            [('a', 'b'), ('b', 'a')],
+            'import b as a, a as b'
+        )
+
+
+class TestMultipleMovesFast(TestMultipleMoves):
+    engine = 'fast'
+
+
+class TestFastEngine(unittest.TestCase):
+    def assert_updated_imports(self, old_code, moves, new_code):
+        self.assertEqual(update_imports_code('not-used.py', old_code, parse_moves(moves))[0], new_code)
+
+    def test_parenthesized(self):
+        self.assert_updated_imports(
+            'from pkg1 import (\n    a,\n    b,\n    c,\n)\nx = 1\n',
+            [('pkg1.b', 'pkg2.b')],
+            'from pkg1 import (\n    a,\n    c,\n)\nfrom pkg2 import b\nx = 1\n'
+        )
+
+    def test_parenthesized_last(self):
+        self.assert_updated_imports(
+            'from pkg1 import (a,\n                  b, c)\n',
+            [('pkg1.b', 'pkg2.b'), ('pkg1.c', 'pkg2.c')],
+            'from pkg1 import (a)\nfrom pkg2 import b, c\n'
+        )
+
+    def test_indented(self):
+        self.assert_updated_imports(
+            'def f():\n    from pkg1 import a, b\n    return a\n',
+            [('pkg1.b', 'pkg2.b')],
+            'def f():\n    from pkg1 import a\n    from pkg2 import b\n    return a\n'
+        )
+
+    def test_scan_matches_parse(self):
+        code = ('"""Doc."""\nfrom __future__ import annotations\nimport os, sys as system\nx = "\u00e9"; from pkg1 import b, c; y = 1\n'
+                'from . import (\n    a,  # comment\n    b,\n)\nif x: import pkg2.mod\n'
+                'def f():\n    import pkg3 \\\n        .mod\n    yield from g()\n    raise E from None\n'
+                'try:\n    from pkg4 import *\nexcept ImportError:\n    pass\ns = "import not_this"\n')
+        dump = lambda nodes: [pyast.dump(node, include_attributes=True) for node in nodes]
+        self.assertEqual(len(scan_import_nodes(code)), 7)
+        self.assertEqual(dump(scan_import_nodes(code)), dump(find_import_nodes(code)))
+
+    def test_shared_line(self):
+        self.assert_updated_imports(
+            'x = "\u00e9"; from pkg1 import b, c; y = 1\n',
+            [('pkg1.b', 'pkg2.b')],
+            'x = "\u00e9"; from pkg1 import c; from pkg2 import b; y = 1\n'
+        )
+
+    def test_after_colon(self):
+        self.assert_updated_imports(
+            'if x: from pkg1 import b\n',
+            [('pkg1.b', 'pkg2.b')],
+            'if x: from pkg2 import b\n'
+        )
+
+    def test_crlf_and_comment(self):
+        self.assert_updated_imports(
+            'from pkg1 import a, b  # hi\r\nz = 1\r\n',
+            [('pkg1.b', 'pkg2.b')],
+            'from pkg1 import a  # hi\r\nfrom pkg2 import b\r\nz = 1\r\n'
+        )
+
+    def test_continued_plain_import(self):
+        self.assert_updated_imports(
+            'import pkg1.x as y, \\\n    pkg1\n',
+            [('pkg1', 'pkg2')],
+            'import pkg2.x as y, \\\n    pkg2 as pkg1\n'
+        )
+
+    def test_untouched_elsewhere(self):
+        code = 'import os\n\n\ndef f( a ):  # odd spacing\n    return "from pkg1 import b"\n'
+        self.assert_updated_imports(code, [('pkg1.b', 'pkg2.b')], code)
+
+
+def _exit_on_die(path):
+    if path == 'die':
+        os._exit(3)
+    return FileResult(path, 'unchanged', 0.0, None, Stats())
+
+
+class TestRecyclingImap(unittest.TestCase):
+    def test_worker_death(self):
+        paths = ['a', 'die', 'b', 'c', 'die', 'd']
+        results = list(_recycling_imap(_exit_on_die, iter(paths), 2, 1024 ** 4))
+        self.assertEqual([res.path for res in results], paths)
+        self.assertEqual([res.status for res in results], ['unchanged', 'error', 'unchanged', 'unchanged', 'error', 'unchanged'])
+        self.assertIn('exit code 3', results[1].error)
+
+
+class TestMoveIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = MoveIndex(parse_moves([('pkg1', 'pkg2'), ('pkg1.utils', 'pkg3'), ('x.y.z', 'w')]))
+
+    def assert_found(self, name, old):
+        move = self.index.find(name)
+        self.assertEqual(move and move[0].full, old)
+
+    def test_exact(self):
+        self.assert_found('pkg1', 'pkg1')
+
+    def test_longest_prefix(self):
+        self.assert_found('pkg1.utils.api', 'pkg1.utils')
+
+    def test_shorter_prefix(self):
+        self.assert_found('pkg1.other', 'pkg1')
+
+    def test_partial_component(self):
+        self.assert_found('pkg10.foo', None)
+        self.assert_found('pkg1.utilsx', 'pkg1')
+
+    def test_no_move_for_parent(self):
+        self.assert_found('x.y', None)
+
+    def test_partial_component_not_updated(self):
+        for code in ['from pkg10.foo import x', 'import pkg10.foo', 'from pkg10 import pkg1']:
+            for engine in ['redbaron', 'fast']:
+                self.assertEqual(updated_code(engine, 'not-used.py', code, self.index), code)
+
+
+class TestPathScanner(unittest.TestCase):
+    def find(self, moves, text):
+        return [(text[start:end], move[1].full) for start, end, move in PathScanner(parse_moves(moves)).find(text)]
+
+    def test_longest_old_path_wins(self):
+        self.assertEqual(self.find([('pkg.mod', 'pkg2.mod'), ('pkg.mod.func', 'pkg3.func')], "'pkg.mod.func' 'pkg.mod.other'"),
+                         [('pkg.mod.func', 'pkg3.func'), ('pkg.mod', 'pkg2.mod')])
+
+    def test_whole_names_only(self):
+        self.assertEqual(self.find([('pkg.mod', 'pkg2.mod')], "pkg.mod10 xpkg.mod a.pkg.mod pkg.mod:main pkg.mod"),
+                         [('pkg.mod', 'pkg2.mod'), ('pkg.mod', 'pkg2.mod')])
+
+    def test_top_level_name_needs_dot(self):
+        self.assertEqual(self.find([('utils', 'pkg.utils')], "'utils' 'utils.api' 'utils:main'"),
+                         [('utils', 'pkg.utils'), ('utils', 'pkg.utils')])
+
+    def test_no_moves(self):
+        self.assertEqual(list(PathScanner([]).find('pkg.mod')), [])
+
+
+class TestParseMoves(unittest.TestCase):
+    def test_duplicates_are_dropped(self):
+        self.assertEqual(len(parse_moves([('a.b', 'c.d'), (' a.b', 'c.d ')])), 1)
+
+    def test_conflict(self):
+        with self.assertRaises(ValueError):
+            parse_moves([('a.b', 'c.d'), ('a.b', 'e.f')])
+
+    def test_chain_warns(self):
+        with self.assertLogs(level='WARNING') as logs:
+            parse_moves([('a', 'b'), ('b.c', 'd')])
+        self.assertEqual(len(logs.output), 1)
+
+    def test_invalid_path(self):
+        for move in [('a.b', 'c..d'), ('a-b', 'c'), ('.a', 'b'), ('a', 'b.class')]:
+            with self.assertRaises(ValueError):
+                parse_moves([move])
+
+    def test_many_to_one(self):
+        with self.assertRaises(ValueError):
+            parse_moves([('a.b', 'c.d'), ('e.f', 'c.d')])
+
+    def test_move_to_self_dropped(self):
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(parse_moves([('a.b', 'a.b')]), [])
+
+    def test_order(self):
+        moves = parse_moves([('a', 'b'), ('x', 'y'), ('b.c', 'd'), ('d', 'e')])
+        self.assertEqual([old.full for old, new in moves], ['x', 'd', 'b.c', 'a'])
+
+    def test_cycle(self):
+        with self.assertLogs(level='WARNING') as logs:
+            moves = parse_moves([('a', 'b'), ('b', 'a'), ('c', 'a.c')])
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('form a cycle', logs.output[0])
+        self.assertIn('chained', logs.output[1])
+        self.assertEqual([old.full for old, new in moves], ['a', 'b', 'c'])
+
+    def test_top_level(self):
+        old, new = parse_moves([('a', 'b.c')])[0]
+        self.assertEqual((old.except_last, old.last), ('', 'a'))
+        self.assertEqual((new.except_last, new.last), ('b', 'c'))
+
+
+class TestLoadMovesFile(unittest.TestCase):
+    def load(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        return load_moves_file(path)
+
+    def test_csv(self):
+        self.assertEqual(self.load('.csv', '# old,new\na.b,c.d\n\ne,f\n'), [('a.b', 'c.d'), ('e', 'f')])
+
+    def test_json_pairs(self):
+        self.assertEqual(self.load('.json', '[["a.b", "c.d"], ["e", "f"]]'), [('a.b', 'c.d'), ('e', 'f')])
+
+    def test_json_object(self):
+        self.assertEqual(self.load('.json', '{"a.b": "c.d"}'), [('a.b', 'c.d')])
+
+    def test_bad_row(self):
+        with self.assertRaises(ValueError):
+            self.load('.csv', 'a.b,c.d,e\n')
+
+    def test_bad_json(self):
+        for content in ('[["a", "b"], ["c"]]', '[[1, 2]]', '{"a": 1}', '["ab"]'):
+            with self.assertRaises(ValueError):
+                self.load('.json', content)
+
+    def test_main_reports_bad_file(self):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('a.b\n')
+        for moves_file, message in [(path, 'expected old,new'), (path + '.missing', 'No such file')]:
+            with mock.patch('sys.argv', ['update_imports.py', '--moves-file', moves_file, path]), self.assertRaises(SystemExit) as cm:
+                main()
+            self.assertIn(message, str(cm.exception.code))
+
 
 class TestAbsModPath(unittest.TestCase):
     def test_absolute(self):
@@ -375,6 +811,675 @@ class TestAbsModPath(unittest.TestCase):
     def test_top_level_parent(self):
         self.assertEqual(abs_mod_path('pkg1/mod1.py', '..pkg2'), 'pkg2')
 
+    def test_package_init(self):
+        self.assertEqual(abs_mod_path('pkg1/pkg2/__init__.py', '.code'), 'pkg1.pkg2.code')
+        self.assertEqual(abs_mod_path('pkg1/pkg2/__init__.py', '..code'), 'pkg1.code')
+        self.assertEqual(abs_mod_path('./pkg1/__init__.py', '.'), 'pkg1')
+
+
+class ProjectTestCase(unittest.TestCase):
+    """Runs each test in a new temp dir, as the cwd, holding files, a dict of
+    paths to their code."""
+    files = {}
+
+    def setUp(self):
+        cwd = os.getcwd()
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        os.chdir(self.root)
+        self.addCleanup(os.chdir, cwd)
+        for path, code in self.files.items():
+            self.write(path, code)
+
+    def write(self, path, code):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(code)
+
+    def read(self, path):
+        with open(os.path.join(self.root, path)) as f:
+            return f.read()
+
+
+class TestRecurse(ProjectTestCase):
+    files = dict.fromkeys(['a.py', 'b.txt', 'skip_me.py', 'pkg/c.py', 'pkg/skip_me.py', 'pkg/sub/d.py', '.hidden/e.py', 'skip_me/f.py'], '')
+
+    def test_defaults(self):
+        self.assertEqual(list(recurse('.')), ['./a.py', './skip_me.py', './pkg/c.py', './pkg/skip_me.py', './pkg/sub/d.py', './skip_me/f.py'])
+
+    def test_is_lazy(self):
+        paths = recurse('.')
+        self.assertEqual(next(paths), './a.py')
+
+    def test_hidden_dirs(self):
+        self.assertIn('./.hidden/e.py', list(recurse('.', hidden_dirs=True)))
+
+    def test_exclude(self):
+        self.assertEqual(list(recurse('.', exclude=re.compile('skip'))), ['./a.py', './pkg/c.py', './pkg/sub/d.py'])
+
+    def test_list_keeps_filters(self):
+        self.assertEqual(list(recurse(['pkg', '.hidden', 'b.txt'], exclude=re.compile('skip'))), ['pkg/c.py', 'pkg/sub/d.py', '.hidden/e.py', 'b.txt'])
+
+    def test_git(self):
+        try:
+            subprocess.check_call(['git', 'init', '-q'])
+        except OSError:
+            self.skipTest("git isn't installed")
+        with open('.gitignore', 'w') as f:
+            f.write('pkg/sub/\n')
+        subprocess.check_call(['git', 'add', 'a.py', 'pkg/c.py'])
+        self.assertEqual(list(recurse('.', exclude=re.compile('skip'), git=True)), ['./a.py', './pkg/c.py'])
+
+
+class TestGitChanged(ProjectTestCase):
+    files = {
+        'pkg/__init__.py': '',
+        'pkg/utils.py': 'import os\n',
+        'pkg/old.py': '',
+        'main.py': 'from pkg import utils\n',
+        'other.py': 'utils = None\n',
+        'gone.py': 'import pkg.old\n',
+        'same.py': 'import os\n',
+    }
+
+    def setUp(self):
+        super(TestGitChanged, self).setUp()
+        try:
+            subprocess.check_call(['git', 'init', '-q'])
+        except OSError:
+            self.skipTest("git isn't installed")
+        self.commit()
+
+    def commit(self):
+        subprocess.check_call(['git', 'add', '-A'])
+        subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'commit'])
+
+    def test_changed_files_and_importers(self):
+        with open('pkg/utils.py', 'a') as f:
+            f.write('import sys\n')
+        with open('new.py', 'w') as f:
+            f.write('x = 1\n')
+        os.rename('pkg/old.py', 'pkg/new_name.py')
+        self.commit()
+        self.assertEqual(list(git_changed('.', 'HEAD~1..HEAD', ['.'])), ['./new.py', './pkg/new_name.py', './pkg/utils.py', './gone.py', './main.py'])
+
+    def test_working_tree(self):
+        with open('same.py', 'a') as f:
+            f.write('import sys\n')
+        self.assertEqual(list(git_changed('.', 'HEAD', ['.'])), ['./same.py'])
+
+    def test_nothing_changed(self):
+        self.assertEqual(list(git_changed('.', 'HEAD', ['.'])), [])
+
+    def test_bad_revision_processes_everything(self):
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(len(list(git_changed('.', 'nosuchrev..HEAD', ['.']))), len(self.files))
+
+
+class TestImportGraph(ProjectTestCase):
+    files = {
+        'pkg1/__init__.py': '',
+        'pkg1/mod1.py': 'from . import utils\nfrom .utils import api\n',
+        'pkg1/utils.py': 'import os\n',
+        'main.py': 'import pkg1.utils\n\nfrom pkg1 import mod1, utils\n',
+        'broken.py': 'from pkg1 import (\n',
+    }
+
+    def setUp(self):
+        super(TestImportGraph, self).setUp()
+        self.graph = ImportGraph()
+        self.graph.update(sorted(self.files))
+
+    def test_importers(self):
+        self.assertEqual(self.graph.importers('pkg1.utils'), {'main.py': [1, 3], 'pkg1/mod1.py': [1, 2]})
+        self.assertEqual(self.graph.importers('pkg1.utils.api'), {'pkg1/mod1.py': [2]})
+        self.assertEqual(self.graph.importers('pkg1.mod1'), {'main.py': [3]})
+        self.assertEqual(self.graph.importers('os'), {'pkg1/utils.py': [1]})
+        self.assertEqual(self.graph.importers('pkg'), {})
+
+    def test_files_for(self):
+        self.assertEqual(self.graph.files_for(parse_moves([('pkg1.mod1', 'pkg2.mod1')])), ['broken.py', 'main.py'])
+
+    def test_incremental_update(self):
+        with open('pkg1/utils.py', 'w') as f:
+            f.write('import pkg1.mod1\n')
+        os.remove('broken.py')
+        self.assertEqual(sorted(self.graph.update(sorted(self.files)[1:])), ['broken.py', 'pkg1/utils.py'])
+        self.assertEqual(self.graph.importers('pkg1.mod1'), {'main.py': [3], 'pkg1/utils.py': [1]})
+        self.assertEqual(self.graph.update(sorted(self.files)[1:]), [])
+
+    def test_save_and_load(self):
+        self.graph.save('index.json')
+        graph = ImportGraph.load('index.json')
+        self.assertEqual(graph.files, self.graph.files)
+        self.assertEqual(graph.importers('pkg1.utils'), self.graph.importers('pkg1.utils'))
+        self.assertEqual(ImportGraph.load('missing.json').files, {})
+
+
+class TestModuleResolver(ProjectTestCase):
+    files = {
+        'pkg1/__init__.py': 'from .sub import func\n',
+        'pkg1/mod1.py': '',
+        'pkg1/sub/__init__.py': 'from .mod2 import *\n',
+        'pkg1/sub/mod2.py': 'def func():\n    pass\n',
+        'pkg1/mod3.py': '',
+        'pkg1/mod3/__init__.py': '',
+        'scripts/run.py': '',
+        'src/pkg2/__init__.py': 'from .sub.mod import func\n',
+        'src/pkg2/mod1.py': '',
+        'src/pkg2/sub/__init__.py': '',
+        'src/pkg2/sub/mod.py': 'def func():\n    pass\n',
+        'src/ns/b.py': '',
+        'ns/a/x.py': '',
+        'main.py': 'from pkg1 import func, mod1\n',
+        'src/main.py': '',
+    }
+
+    def setUp(self):
+        super(TestModuleResolver, self).setUp()
+        self.resolver = ModuleResolver(default_roots('.'))
+
+    def test_default_roots(self):
+        self.assertEqual(default_roots(['.']), ['.', './src'])
+        self.assertEqual(default_roots(['pkg1/mod1.py', 'pkg1']), ['pkg1'])
+
+    def test_resolve(self):
+        self.assertEqual(self.resolver.resolve('pkg1'), ('package', [self.root + '/pkg1/__init__.py'], [self.root + '/pkg1']))
+        self.assertEqual(self.resolver.resolve('pkg1.sub.mod2'), ('module', [self.root + '/pkg1/sub/mod2.py'], []))
+        self.assertEqual(self.resolver.resolve('pkg2.mod1'), ('module', [self.root + '/src/pkg2/mod1.py'], []))
+        self.assertEqual(self.resolver.resolve('scripts.run'), ('module', [self.root + '/scripts/run.py'], []))
+        self.assertEqual(self.resolver.resolve('ns'), ('namespace', [], [self.root + '/ns', self.root + '/src/ns']))
+        self.assertEqual(self.resolver.resolve('ns.b').paths, [self.root + '/src/ns/b.py'])
+        self.assertEqual(self.resolver.resolve('ns.a.x').kind, 'module')
+        self.assertEqual(self.resolver.resolve('main').paths, [self.root + '/main.py', self.root + '/src/main.py'])
+        self.assertIsNone(self.resolver.resolve('pkg3'))
+        self.assertIsNone(self.resolver.resolve('pkg1.mod1.func'))
+
+    def test_find(self):
+        self.assertEqual(self.resolver.find('pkg1.sub.mod2.func')[0], 'pkg1.sub.mod2')
+        self.assertEqual(self.resolver.find('ns.c'), (None, None))
+        self.assertEqual(self.resolver.describe('pkg1.sub'), 'package pkg1/sub')
+        self.assertEqual(self.resolver.describe('pkg2.mod1.func'), 'in module src/pkg2/mod1.py')
+        self.assertEqual(self.resolver.describe('ns'), 'namespace package ns, src/ns')
+
+    def test_reexports(self):
+        moves = parse_moves([('pkg1.sub.mod2.func', 'pkg1.mod1.func'), ('pkg1.mod1', 'pkg1.mod4')])
+        self.assertEqual([name for name, move in self.resolver.reexports(moves)], ['pkg1.sub.func', 'pkg1.func'])
+        moves = parse_moves([('pkg2.sub.mod.func', 'pkg2.mod1.func')])
+        self.assertEqual([name for name, move in self.resolver.reexports(moves)], ['pkg2.func'])
+
+    def test_reexport_warning(self):
+        moves = parse_moves([('pkg1.sub.mod2.func', 'pkg1.mod1.func')])
+        with self.assertLogs(level='WARNING') as logs:
+            update_imports(['main.py'], MoveIndex(moves, reexports=self.resolver.reexports(moves)))
+        self.assertIn("'from pkg1 import func' imports pkg1.sub.mod2.func through pkg1, which re-exports it", logs.output[0])
+
+    def test_check_moves(self):
+        with self.assertLogs(level='WARNING') as logs:
+            warnings = check_moves(parse_moves([('pkg1.mod1', 'pkg3.mod1'), ('pkg4.mod1', 'pkg1.sub.mod1'), ('pkg5', 'pkg6'), ('pkg1.mod3.f', 'pkg1.f')]),
+                                   self.resolver)
+        self.assertEqual(warnings, 2)
+        self.assertIn('Neither pkg5 nor pkg6', logs.output[0])
+        self.assertIn('pkg1.mod3 is ambiguous', logs.output[1])
+
+    def test_plan_exit_status(self):
+        with mock.patch('sys.argv', ['update_imports.py', '--plan', '-m', 'pkg1.mod1,pkg1.mod4', '.']), mock.patch('sys.stdout', io.StringIO()) as out:
+            main()
+        self.assertIn('pkg1.mod1 -> pkg1.mod4', out.getvalue())
+        with mock.patch('sys.argv', ['update_imports.py', '--plan', '-m', 'nothere.x,nope.y', '.']), mock.patch('sys.stdout', io.StringIO()), \
+                self.assertLogs(level='WARNING'), self.assertRaises(SystemExit) as cm:
+            main()
+        self.assertEqual(cm.exception.code, 1)
+
+
+class TestImportServer(ProjectTestCase):
+    engine = 'redbaron'
+    files = TestImportGraph.files
+
+    def setUp(self):
+        super(TestImportServer, self).setUp()
+        self.server = ImportServer('./', engine=self.engine, max_trees=2)
+        self.server.refresh()
+
+    def test_successive_moves(self):
+        response = self.server.handle({'id': 1, 'moves': [['pkg1.utils', 'pkg2.utils']]})
+        self.assertEqual(response['id'], 1)
+        self.assertEqual(response['modified'], ['./main.py', './pkg1/mod1.py'])
+        self.assertEqual([e['path'] for e in response['errors']], ['./broken.py'])
+        self.assertEqual(self.read('main.py'), 'import pkg2.utils\n\nfrom pkg1 import mod1\nfrom pkg2 import utils\n')
+        self.assertLessEqual(len(self.server.trees), 2)
+
+        response = self.server.handle({'moves': {'pkg2.utils': 'pkg3.utils'}})
+        self.assertEqual(response['modified'], ['./main.py', './pkg1/mod1.py'])
+        self.assertEqual(self.read('main.py'), 'import pkg3.utils\n\nfrom pkg1 import mod1\nfrom pkg3 import utils\n')
+
+    def test_changed_file_is_reparsed(self):
+        self.server.handle({'moves': [['pkg1.mod1', 'pkg2.mod1']]})
+        with open('main.py', 'w') as f:
+            f.write('import os\nimport pkg1.utils # changed\n')
+        response = self.server.handle({'moves': [['pkg1.utils', 'pkg2.utils']]})
+        self.assertIn('./main.py', response['modified'])
+        self.assertEqual(self.read('main.py'), 'import os\nimport pkg2.utils # changed\n')
+
+    def test_serve(self):
+        requests = io.StringIO('{"id": "a", "moves": [["pkg1.mod1", "pkg2.mod1"]]}\n\nnot json\n{"moves": [["pkg1"]]}\n')
+        out = io.StringIO()
+        self.server.serve(requests, out)
+        responses = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([r['id'] for r in responses], ['a', None, None])
+        self.assertEqual(responses[0]['modified'], ['./main.py'])
+        self.assertIn('error', responses[1])
+        self.assertIn('error', responses[2])
+
+    def test_move_error_is_returned(self):
+        with mock.patch.object(self.server, 'refresh', side_effect=OSError("Permission denied")):
+            response = self.server.handle({'id': 1, 'moves': [['pkg1.mod1', 'pkg2.mod1']]})
+        self.assertEqual(response, {'id': 1, 'error': 'OSError: Permission denied'})
+
+    def test_socket_only_replaces_a_socket(self):
+        with open('victim.py', 'w') as f:
+            f.write('x = 1\n')
+        with self.assertRaises(ValueError):
+            self.server.serve_socket('victim.py')
+        self.assertEqual(self.read('victim.py'), 'x = 1\n')
+
+
+class TestImportServerFast(TestImportServer):
+    engine = 'fast'
+
+
+class TestImportUpdater(unittest.TestCase):
+    engine = 'redbaron'
+
+    def setUp(self):
+        self.updater = ImportUpdater([('pkg1.utils', 'pkg2.utils')], engine=self.engine)
+
+    def test_update(self):
+        sources = {
+            'main.py': 'import pkg1.utils\nfrom pkg1 import mod1, utils\n',
+            'pkg1/mod1.py': b'from .utils import api\n',
+            'other.py': 'import os\n',
+        }
+        results = {res.path: res for res in self.updater.update(sources)}
+        self.assertEqual(results['main.py'].source, 'import pkg2.utils\nfrom pkg1 import mod1\nfrom pkg2 import utils\n')
+        self.assertEqual(results['pkg1/mod1.py'].source, b'from pkg2.utils import api\n')
+        self.assertEqual([edit['line'] for edit in results['main.py'].edits], [1, 2])
+        self.assertFalse(results['other.py'].changed)
+        self.assertIs(results['other.py'].source, sources['other.py'])
+
+    def test_errors_and_warnings(self):
+        broken, moved = self.updater.update([('broken.py', 'from pkg1 import (\n'), ('moved.py', 'import pkg1.utils\npkg1.other()\n')])
+        self.assertFalse(broken.changed)
+        self.assertTrue(broken.error)
+        self.assertEqual(len(moved.warnings), 1)
+        self.assertIn("can't update pkg1.other", moved.warnings[0])
+
+    def test_strings(self):
+        updater = ImportUpdater([('pkg1.utils', 'pkg2.utils')], engine=self.engine, strings='update')
+        res, cfg = updater.update([('test.py', "patch('pkg1.utils.api')\n"), ('setup.cfg', 'x = pkg1.utils:main\n')])
+        self.assertEqual(res.source, "patch('pkg2.utils.api')\n")
+        self.assertEqual(cfg.source, 'x = pkg2.utils:main\n')
+
+    def test_concurrent_calls(self):
+        sources = [('mod%d.py' % i, 'import pkg1.utils\nfrom pkg1.utils import f%d\npkg1.other()\n' % i) for i in range(50)]
+        expected = [(res.source, res.warnings) for res in self.updater.update(sources)]
+        self.assertTrue(all(warnings for source, warnings in expected))
+        results = {}
+
+        def run(n):
+            results[n] = [(res.source, res.warnings) for res in self.updater.update(sources)]
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, dict.fromkeys(range(4), expected))
+
+
+class TestImportUpdaterFast(TestImportUpdater):
+    engine = 'fast'
+
+
+class TestMayNeedUpdate(unittest.TestCase):
+    def assert_may_need_update(self, path, source, moves, expected):
+        heads = move_heads(parse_moves(moves))
+        self.assertEqual(may_need_update(path, source, heads), expected)
+
+    def test_no_imports(self):
+        self.assert_may_need_update('mod.py', b'pkg1 = 1\n', [('pkg1.utils', 'pkg2.utils')], False)
+
+    def test_unrelated_import(self):
+        self.assert_may_need_update('mod.py', b'import os\nfrom pkg10 import utils\n', [('pkg1.utils', 'pkg2.utils')], False)
+
+    def test_from_import(self):
+        self.assert_may_need_update('mod.py', b'import os\nfrom pkg1.x import utils\n', [('pkg1.utils', 'pkg2.utils')], True)
+
+    def test_plain_import_not_first(self):
+        self.assert_may_need_update('mod.py', b'import os, pkg1.utils as u\n', [('pkg1.utils', 'pkg2.utils')], True)
+
+    def test_plain_import_continued(self):
+        self.assert_may_need_update('mod.py', b'import os, \\\n    pkg1\n', [('pkg1.utils', 'pkg2.utils')], True)
+
+    def test_relative_import(self):
+        self.assert_may_need_update('pkg1/mod1.py', b'from . import utils\n', [('pkg1.utils', 'pkg2.utils')], True)
+
+    def test_relative_import_elsewhere(self):
+        self.assert_may_need_update('pkg3/mod1.py', b'from . import utils\n', [('pkg1.utils', 'pkg2.utils')], False)
+
+    def test_relative_import_up_a_level(self):
+        self.assert_may_need_update('pkg3/mod1.py', b'from ..pkg1 import utils\n', [('pkg1.utils', 'pkg2.utils')], True)
+
+
+class TestUpdateImports(ProjectTestCase):
+    files = {
+        'pkg1/__init__.py': '',
+        'pkg1/mod1.py': 'from . import utils\nfrom .utils import api\n',
+        'pkg1/utils.py': 'import os\n',
+        'main.py': 'import pkg1.utils\nfrom pkg1 import mod1, utils\n',
+        'broken.py': 'from pkg1 import (\n',
+    }
+
+    def read_all(self):
+        return {path: self.read(path) for path in self.files}
+
+    def run_update(self, moves, jobs=1, engine='fast'):
+        paths = sorted(recurse('.')) + ['./main.py']
+        return update_imports(paths, parse_moves(moves), jobs=jobs, engine=engine)
+
+    def test_parallel_matches_serial(self):
+        moves = [('pkg1.utils', 'pkg2.utils')]
+        serial_errors = self.run_update(moves)
+        serial = self.read_all()
+        for path, code in self.files.items():
+            self.write(path, code)
+        parallel_errors = self.run_update(moves, jobs=3)
+        self.assertEqual(self.read_all(), serial)
+        self.assertEqual(parallel_errors, serial_errors)
+        self.assertEqual(serial['main.py'], 'import pkg2.utils\nfrom pkg1 import mod1\nfrom pkg2 import utils\n')
+
+    def test_strings(self):
+        self.write('tests.py', "@mock.patch('pkg1.utils.api')\ndef test(): 'pkg1.utils is moved'  # pkg1.utils\n")
+        self.write('setup.cfg', '[options.entry_points]\nconsole_scripts =\n    tool = pkg1.utils:main\n')
+        moves = parse_moves([('pkg1.utils', 'pkg2.utils')])
+        with self.assertLogs(level='WARNING') as logs:
+            update_imports(sorted(recurse('.', config=True)), moves, strings=PathScanner(moves, rewrite=False))
+        references = [line for line in logs.output if 'reference to' in line]
+        self.assertEqual(references, ['WARNING:root:./setup.cfg:3: reference to pkg1.utils, which is moved to pkg2.utils',
+                                      'WARNING:root:./tests.py:1: reference to pkg1.utils, which is moved to pkg2.utils',
+                                      'WARNING:root:./tests.py:2: reference to pkg1.utils, which is moved to pkg2.utils'])
+        with open('tests.py') as f:
+            self.assertIn('pkg1.utils.api', f.read())
+        update_imports(sorted(recurse('.', config=True)), moves, strings=PathScanner(moves))
+        self.assertEqual(self.read('tests.py'), "@mock.patch('pkg2.utils.api')\ndef test(): 'pkg2.utils is moved'  # pkg1.utils\n")
+        self.assertEqual(self.read('setup.cfg'), '[options.entry_points]\nconsole_scripts =\n    tool = pkg2.utils:main\n')
+        self.assertEqual(self.read('main.py'), 'import pkg2.utils\nfrom pkg1 import mod1\nfrom pkg2 import utils\n')
+
+    def test_journal_resume(self):
+        moves = parse_moves([('pkg1.utils', 'pkg2.utils')])
+        journal_path = os.path.join(self.root, 'journal')
+        settings = {'moves': [['pkg1.utils', 'pkg2.utils']]}
+        journal = Journal(journal_path, settings)
+        update_imports(sorted(recurse('.')), moves, journal=journal)
+        journal.close()
+        self.assertEqual(sorted(journal.done), ['./main.py', './pkg1/__init__.py', './pkg1/mod1.py', './pkg1/utils.py'])
+        with open(journal_path, 'a') as f:
+            f.write('{"path": "./pk') # killed part way through a line
+        self.write('main.py', 'import pkg1.utils\n')
+
+        journal = Journal(journal_path, settings, resume=True)
+        with mock.patch('update_imports._process_file', wraps=_process_file) as process:
+            update_imports(sorted(recurse('.')), moves, journal=journal)
+        journal.close()
+        self.assertEqual(sorted(call[0][0] for call in process.call_args_list), ['./broken.py', './main.py'])
+        self.assertEqual(journal.resumed, 3)
+        self.assertEqual(Journal(journal_path, settings, resume=True).done['./main.py'], journal.done['./main.py'])
+
+        with self.assertLogs(level='WARNING'):
+            journal = Journal(journal_path, {'moves': [['pkg1.mod1', 'pkg2.mod1']]}, resume=True)
+        self.assertEqual(journal.done, {})
+        journal.close()
+        with open(journal_path) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_verify(self):
+        moves = parse_moves([('pkg1.utils', 'pkg2.utils')])
+        before = self.read_all()
+        errors = update_imports(sorted(recurse('.')), moves, verify=ModuleResolver(['.']))
+        self.assertEqual(sorted(path for path, error in errors), ['./broken.py', './main.py', './pkg1/mod1.py'])
+        self.assertIn("imports pkg2.utils, which isn't in the project", dict(errors)['./main.py'])
+        self.assertEqual(self.read_all(), before)
+
+        self.write('pkg2/__init__.py', '')
+        os.rename('pkg1/utils.py', 'pkg2/utils.py')
+        self.assertEqual(update_imports(sorted(recurse('.')), moves, jobs=2, verify=ModuleResolver(['.'])), [('./broken.py', mock.ANY)])
+        self.assertEqual(self.read('main.py'), 'import pkg2.utils\nfrom pkg1 import mod1\nfrom pkg2 import utils\n')
+
+    def test_verify_package_names(self):
+        self.write('pkg2/__init__.py', 'from .sub import thing\nVERSION = 1\n')
+        self.write('other.py', 'from pkg1 import utils\n')
+        errors = update_imports(['other.py'], parse_moves([('pkg1.utils', 'pkg2.nothere')]), verify=ModuleResolver(['.']))
+        self.assertIn("imports pkg2.nothere, which isn't in the project", errors[0][1])
+        self.assertEqual(update_imports(['other.py'], parse_moves([('pkg1.utils', 'pkg2.thing')]), verify=ModuleResolver(['.'])), [])
+        self.assertEqual(self.read('other.py'), 'from pkg2 import thing as utils\n')
+
+    def test_verify_compiles(self):
+        with mock.patch('update_imports.update_imports_parsed', return_value='import pkg2.utils\n  x = 1\n'):
+            errors = update_imports(['main.py'], parse_moves([('pkg1.utils', 'os')]), verify=ModuleResolver(['.']))
+        self.assertIn("doesn't compile", errors[0][1])
+        self.assertEqual(self.read_all()['main.py'], self.files['main.py'])
+
+    def test_diff(self):
+        moves = [('pkg1.utils', 'pkg2.utils')]
+        serial, parallel = io.StringIO(), io.StringIO()
+        update_imports(sorted(recurse('.')), parse_moves(moves), diff_out=serial)
+        update_imports(sorted(recurse('.')), parse_moves(moves), jobs=3, diff_out=parallel)
+        self.assertEqual(self.read_all(), self.files)
+        self.assertEqual(parallel.getvalue(), serial.getvalue())
+        self.assertEqual(serial.getvalue().splitlines()[:7], [
+            '--- a/main.py',
+            '+++ b/main.py',
+            '@@ -1,2 +1,3 @@',
+            '-import pkg1.utils',
+            '-from pkg1 import mod1, utils',
+            '+import pkg2.utils',
+            '+from pkg1 import mod1',
+        ])
+        subprocess.check_call(['git', 'init', '-q'])
+        subprocess.run(['git', 'apply'], input=serial.getvalue().encode('utf-8'), check=True)
+        diffed = self.read_all()
+        for path, code in self.files.items():
+            self.write(path, code)
+        self.run_update(moves)
+        self.assertEqual(diffed, self.read_all())
+
+    def test_diff_no_newline_at_end(self):
+        self.write('main.py', 'import pkg1.utils')
+        out = io.StringIO()
+        update_imports(['main.py'], parse_moves([('pkg1.utils', 'pkg2.utils')]), diff_out=out)
+        self.assertEqual(out.getvalue().splitlines()[-4:], [
+            '-import pkg1.utils', '\\ No newline at end of file', '+import pkg2.utils', '\\ No newline at end of file'])
+
+    def test_report(self):
+        self.write('refs.py', 'import pkg1.utils\npkg1.utils.f()\npkg1.mod1.g()\n')
+        moves = parse_moves([('pkg1.utils', 'pkg2.utils')])
+        reports = []
+        for engine, jobs in [('fast', 1), ('redbaron', 1), ('fast', 2)]:
+            for path, code in self.files.items():
+                self.write(path, code)
+            self.write('refs.py', 'import pkg1.utils\npkg1.utils.f()\npkg1.mod1.g()\n')
+            out = io.StringIO()
+            update_imports(sorted(recurse('.')), moves, jobs=jobs, engine=engine, report_out=out)
+            reports.append([json.loads(line) for line in out.getvalue().splitlines()])
+        self.assertEqual(reports[1], reports[0])
+        self.assertEqual(reports[2], reports[0])
+        records = [r for r in reports[0] if r['type'] != 'error']
+        self.assertEqual(records[:3], [
+            {'type': 'edit', 'file': './main.py', 'line': 1, 'old': 'import pkg1.utils', 'new': 'import pkg2.utils', 'moves': [['pkg1.utils', 'pkg2.utils']]},
+            {'type': 'edit', 'file': './main.py', 'line': 2, 'old': 'from pkg1 import mod1, utils', 'new': 'from pkg1 import mod1\nfrom pkg2 import utils',
+             'moves': [['pkg1.utils', 'pkg2.utils']]},
+            {'type': 'edit', 'file': './pkg1/mod1.py', 'line': 1, 'old': 'from . import utils', 'new': 'from pkg2 import utils',
+             'moves': [['pkg1.utils', 'pkg2.utils']]},
+        ])
+        self.assertEqual(records[5]['old'], 'pkg1.utils')
+        self.assertEqual((records[6]['type'], records[6]['file']), ('warning', './refs.py'))
+        self.assertIn("can't update pkg1.mod1.g", records[6]['message'])
+        self.assertEqual([r['file'] for r in reports[0] if r['type'] == 'error'], ['./broken.py'])
+
+    def test_engines_match(self):
+        moves = [('pkg1.utils', 'pkg2.utils')]
+        self.run_update(moves, engine='redbaron')
+        redbaron = self.read_all()
+        for path, code in self.files.items():
+            self.write(path, code)
+        self.run_update(moves)
+        self.assertEqual(self.read_all(), redbaron)
+
+    def test_fast_engine_falls_back(self):
+        self.write('py2.py', 'from pkg1 import utils\nprint "hi"\n')
+        self.assertTrue(update_imports_file('py2.py', parse_moves([('pkg1', 'pkg2')])))
+        self.assertEqual(self.read('py2.py'), 'from pkg2 import utils\nprint "hi"\n')
+
+    def test_stats(self):
+        stats = RunStats(slowest=2)
+        update_imports(['main.py', 'pkg1/mod1.py', 'pkg1/utils.py'], parse_moves([('pkg1.utils', 'pkg2.utils')]), stats=stats)
+        self.assertEqual((stats.files, stats.imports, stats.edits), (3, 4, 4))
+        self.assertEqual(len(stats.slowest), 2)
+        out = io.StringIO()
+        stats.report(out)
+        self.assertIn('3 files, 4 import statements examined, 4 imports updated', out.getvalue())
+
+    def test_stats_peak_memory(self):
+        stats = RunStats(slowest=2)
+        update_imports(['main.py', 'pkg1/mod1.py', 'pkg1/utils.py'], parse_moves([('pkg1.utils', 'pkg2.utils')]), stats=stats)
+        self.assertGreater(stats.peak_rss, 0)
+        self.assertEqual(len(stats.largest), 2)
+        out = io.StringIO()
+        stats.report(out)
+        self.assertIn('Peak memory', out.getvalue())
+
+    def test_large_files_only_parse_imports(self):
+        moves = [('pkg1.utils', 'pkg2.utils')]
+        self.run_update(moves)
+        expected = self.read_all()
+        for engine in ['fast', 'redbaron']:
+            for path, code in self.files.items():
+                self.write(path, code)
+            with mock.patch('update_imports.find_import_nodes', side_effect=AssertionError), \
+                    mock.patch('update_imports.RedBaron', side_effect=AssertionError):
+                update_imports(sorted(recurse('.')), parse_moves(moves), engine=engine, large_file=0)
+            self.assertEqual(self.read_all(), expected)
+
+    def test_large_files_skip_references(self):
+        self.write('refs.py', 'import pkg1.utils\npkg1.utils.f()\n')
+        with self.assertLogs(level='WARNING') as logs, mock.patch('update_imports._reference_edits', side_effect=AssertionError):
+            update_imports_file('refs.py', parse_moves([('pkg1.utils', 'pkg2.utils')]), large_file=0)
+        self.assertIn("not updating references to pkg1", logs.output[0])
+        self.assertEqual(self.read('refs.py'), 'import pkg2.utils\npkg1.utils.f()\n')
+
+    def test_memory_limit_recycles_workers(self):
+        moves = [('pkg1.utils', 'pkg2.utils')]
+        serial_errors = self.run_update(moves)
+        serial = self.read_all()
+        for path, code in self.files.items():
+            self.write(path, code)
+        stats = RunStats()
+        errors = update_imports(sorted(recurse('.')) + ['./main.py'], parse_moves(moves), jobs=2, max_rss=1, stats=stats)
+        self.assertEqual(self.read_all(), serial)
+        self.assertEqual(errors, serial_errors)
+        self.assertEqual(stats.files, len(self.files))
+
+    def test_jobs_must_be_positive(self):
+        with mock.patch('sys.argv', ['update_imports.py', '-j', '0', '--max-memory', '100', '-m', 'pkg1,pkg2']), \
+                mock.patch('sys.stderr', io.StringIO()) as stderr, self.assertRaises(SystemExit):
+            parse_args()
+        self.assertIn('--jobs must be at least 1', stderr.getvalue())
+
+    def test_errors_are_collected(self):
+        errors = self.run_update([('pkg1.utils', 'pkg2.utils')], jobs=2)
+        self.assertEqual([path for path, error in errors], ['./broken.py'])
+        self.assertEqual(self.read_all()['pkg1/mod1.py'], 'from pkg2 import utils\nfrom pkg2.utils import api\n')
+
+    def test_unchanged_file_not_written(self):
+        self.write('other.py', 'from pkg1 import mod1\n')
+        os.utime('other.py', (1000000000, 1000000000))
+        self.assertFalse(update_imports_file('other.py', parse_moves([('pkg1.utils', 'pkg2.utils')])))
+        self.assertEqual(os.stat('other.py').st_mtime, 1000000000)
+
+    def test_changed_file_keeps_mode_and_newlines(self):
+        with open('other.py', 'wb') as f:
+            f.write(b'from pkg1 import utils\r\nx = 1\r\n')
+        os.chmod('other.py', 0o751)
+        self.assertTrue(update_imports_file('other.py', parse_moves([('pkg1', 'pkg2')])))
+        with open('other.py', 'rb') as f:
+            self.assertEqual(f.read(), b'from pkg2 import utils\r\nx = 1\r\n')
+        self.assertEqual(os.stat('other.py').st_mode & 0o777, 0o751)
+        self.assertEqual(sorted(os.listdir('.')), ['broken.py', 'main.py', 'other.py', 'pkg1'])
+
+    def test_symlink_written_through(self):
+        os.symlink(os.path.join('pkg1', 'mod1.py'), 'link.py')
+        self.run_update([('pkg1.utils', 'pkg2.utils')])
+        self.assertTrue(os.path.islink('link.py'))
+        self.assertEqual(self.read_all()['pkg1/mod1.py'], 'from pkg2 import utils\nfrom pkg2.utils import api\n')
+        self.assertEqual(sorted(os.listdir('pkg1')), ['__init__.py', 'mod1.py', 'utils.py'])
+        os.symlink('main.py', 'main_link.py')
+        self.assertTrue(update_imports_file('main_link.py', parse_moves([('pkg2.utils', 'pkg3.utils')])))
+        self.assertTrue(os.path.islink('main_link.py'))
+        self.assertEqual(self.read_all()['main.py'], 'import pkg3.utils\nfrom pkg1 import mod1\nfrom pkg3 import utils\n')
+
+    def test_cache_skips_parsing(self):
+        cache = ImportCache(os.path.join(self.root, '.cache'))
+        update_imports(['main.py'], parse_moves([('pkg1.other', 'pkg2.other')]), cache=cache)
+        with open('main.py', 'rb') as f:
+            self.assertEqual(cache.get('main.py', f.read()), [['import', 'pkg1.utils', []], ['from', 'pkg1', ['mod1', 'utils']]])
+        with mock.patch('update_imports.RedBaron', side_effect=AssertionError("parsed")), \
+                mock.patch('update_imports.find_import_nodes', side_effect=AssertionError("parsed")):
+            self.assertEqual(update_imports(['main.py'], parse_moves([('pkg1.stuff', 'pkg2.stuff')]), cache=cache), [])
+            self.assertEqual(len(update_imports(['main.py'], parse_moves([('pkg1.utils', 'pkg2.utils')]), cache=cache)), 1)
+
+    def test_cache_caches_updated_file(self):
+        cache = ImportCache(os.path.join(self.root, '.cache'))
+        update_imports(['main.py'], parse_moves([('pkg1.utils', 'pkg2.utils')]), cache=cache)
+        with open('main.py', 'rb') as f:
+            self.assertEqual(cache.get('main.py', f.read()), [['import', 'pkg2.utils', []], ['from', 'pkg1', ['mod1']], ['from', 'pkg2', ['utils']]])
+
+    def test_cache_prune(self):
+        cache = ImportCache(os.path.join(self.root, '.cache'), max_bytes=250)
+        os.makedirs(os.path.join(self.root, '.cache', 'v%d' % (CACHE_VERSION - 1)))
+        for i in range(10):
+            cache.put('mod%d.py' % i, b'', [['import', 'pkg%d' % i, []]] * 3)
+            os.utime(cache._entry('mod%d.py' % i, b''), (i, i))
+        cache.prune()
+        self.assertEqual(os.listdir(os.path.join(self.root, '.cache')), ['v%d' % CACHE_VERSION])
+        self.assertEqual([i for i in range(10) if cache.get('mod%d.py' % i, b'')], [7, 8, 9])
+
+
+class TestStartup(unittest.TestCase):
+    """Startup cost matters for short runs, like hooks run on every commit."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'update_imports.py')
+
+    def run_python(self, *args):
+        """Run python with args a few times and return the fastest time."""
+        times = []
+        for _ in range(3):
+            start = time.time()
+            subprocess.run([sys.executable] + list(args), check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=tempfile.gettempdir())
+            times.append(time.time() - start)
+        return min(times)
+
+    def test_redbaron_not_imported_until_needed(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        code = ('import sys; sys.path.insert(0, %r); import update_imports; '
+                'sys.argv = ["update_imports.py", "-m", "a,b", %r]; update_imports.main(); '
+                'assert "redbaron" not in sys.modules and "baron" not in sys.modules, "imported redbaron"'
+                % (os.path.dirname(self.script), root))
+        subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def test_help_is_cheaper_than_importing_redbaron(self):
+        self.assertLess(self.run_python(self.script, '--help'), self.run_python('-c', 'import redbaron'))
+
 
 if __name__ == '__main__':
     unittest.main()
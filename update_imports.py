@@ -4,17 +4,51 @@
 """See README.md for details."""
 
 import argparse
+import ast as pyast
+import bisect
+import cProfile
+import csv
+import difflib
+import hashlib
+import heapq
+import importlib.util
+import io
+import json
+import keyword
 import logging
+import multiprocessing
 import os
 import re
+import shutil
+import socketserver
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
 import time
-from collections import namedtuple
-from importlib import import_module
+import tokenize
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing.connection import wait
 
-from redbaron import CommentNode, RedBaron
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
 
 log = logging.getLogger()
 
+_redbaron = None # the redbaron module once redbaron() has imported it, or False if it isn't installed
+
+# Bump this whenever the format of import tables or the way they're built
+# changes, so entries cached by older versions are ignored (and removed).
+CACHE_VERSION = 1
+
+ModPath = namedtuple('ModPath', ['full', 'except_last', 'last'])
+FileResult = namedtuple('FileResult', ['path', 'status', 'elapsed', 'error', 'stats', 'diff', 'report', 'digest'], defaults=[None, None, None])
+
 
 def main():
     args = parse_args()
@@ -27,185 +61,2835 @@ def main():
     exre = None
     if args.exclude:
         exre = re.compile(args.exclude)
-    paths = recurse(args.path, hidden_dirs=args.hidden_dirs, exclude=exre)
-    old, new = [x.strip() for x in args.move.split(',')]
-    moves = parse_moves([(old, new)]) # only 1 move at a time for now
-    update_imports(paths, moves)
+    if args.serve or args.socket:
+        server = ImportServer(args.path, hidden_dirs=args.hidden_dirs, exclude=exre, git=args.git, engine=args.engine, max_trees=args.max_trees,
+                              roots=args.root)
+        server.refresh()
+        if args.socket:
+            try:
+                server.serve_socket(args.socket)
+            except KeyboardInterrupt:
+                pass
+            except ValueError as e:
+                sys.exit("error: %s" % e)
+        else:
+            server.serve(sys.stdin, sys.stdout)
+        return
+    if args.since:
+        paths = list(git_changed(args.path, args.since, args.root or default_roots(args.path), hidden_dirs=args.hidden_dirs, exclude=exre))
+        log.info("Processing %d files changed in %s or importing modules that did", len(paths), args.since)
+    else:
+        paths = recurse(args.path, hidden_dirs=args.hidden_dirs, exclude=exre, git=args.git, config=bool(args.strings))
+    if args.plan or (args.strings and args.index):
+        paths = list(paths)
+    graph = None
+    if args.index or args.who_imports or args.plan:
+        graph = ImportGraph.load(args.index) if args.index else ImportGraph()
+        changed = graph.update([path for path in paths if path.endswith('.py')] if args.strings else paths, complete=not args.since)
+        log.info("Indexed %d changed files of %d", len(changed), len(graph.files))
+        if args.index:
+            graph.save(args.index)
+    if args.who_imports:
+        for path, lines in sorted(graph.importers(args.who_imports).items()):
+            for line in lines:
+                print("%s:%d" % (path, line))
+        return
+
+    moves = args.move or []
+    try:
+        if args.moves_file:
+            moves += load_moves_file(args.moves_file)
+        moves = parse_moves(moves)
+    except (ValueError, OSError) as e:
+        sys.exit("error: %s" % e)
+    resolver = ModuleResolver(args.root or default_roots(args.path))
+    if args.plan:
+        warnings = check_moves(moves, resolver)
+        print_plan(moves, resolver, graph, sys.stdout)
+        if warnings:
+            sys.exit(1)
+        return
+    moves = MoveIndex(moves, reexports=resolver.reexports(moves))
+    cache = None
+    if args.cache_dir:
+        cache = ImportCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+    stats = RunStats(args.stats) if args.stats is not None else None
+    profile = None
+    if args.profile:
+        if args.jobs > 1 or args.max_memory:
+            log.warning("Only the main process is profiled, not the worker processes")
+        profile = cProfile.Profile()
+        profile.enable()
+    strings = PathScanner(moves, rewrite=args.strings == 'update') if args.strings else None
+    if graph and not strings:
+        since = set(paths) if args.since else None
+        paths = [path for path in graph.files_for(moves) if since is None or path in since]
+    journal = None
+    if args.journal:
+        journal = Journal(args.journal, {'moves': [[old.full, new.full] for old, new in moves], 'strings': args.strings}, resume=args.resume)
+    try:
+        errors = update_imports(paths, moves, jobs=args.jobs, cache=cache, engine=args.engine, stats=stats,
+                                diff_out=sys.stdout if args.diff else None, report_out=sys.stdout if args.report else None,
+                                max_rss=args.max_memory * 1024 * 1024 if args.max_memory else None,
+                                large_file=args.large_file * 1024 if args.large_file is not None else None, strings=strings, journal=journal,
+                                verify=resolver if args.verify else None)
+    finally:
+        if journal:
+            journal.close()
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
+    if stats:
+        stats.report(sys.stderr)
+    if errors:
+        sys.exit(1)
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("--hidden-dirs", action="store_true", help="descent into hidden dirs")
     parser.add_argument("-x", "--exclude", help="exclude files and dirs matching regexp", type=str)
+    parser.add_argument("--git", action="store_true", help="get files from `git ls-files` instead of walking dirs, skipping files git ignores")
+    parser.add_argument("--since", help="only process .py files git says were added or modified in this revision range (eg main..HEAD), "
+                        "or since this revision if it's not a range, and files importing modules that were changed, moved or removed in it",
+                        type=str, metavar="REVS")
     parser.add_argument("-v", "--verbose", help="print more", action="store_true")
     parser.add_argument("-d", "--debug", help="print even more", action="store_true")
-    parser.add_argument("-m", "--move", help="a package/module/symbol move in the form of 'from.here,to.here'", type=str, required=True)
+    parser.add_argument("-j", "--jobs", help="number of files to process in parallel (default 1)", type=int, default=1)
+    parser.add_argument("--max-memory", help="replace any worker process using more than this many MB after a file with a new one; "
+                        "files are processed in worker processes even without --jobs", type=int, metavar="MB")
+    parser.add_argument("--large-file", help="only parse the import statements of files bigger than this many KB, not the whole file (default 1024)",
+                        type=int, default=1024, metavar="KB")
+    parser.add_argument("--root", help="a dir to find top level modules in; can be given more than once (default the paths run on, and their src dirs)",
+                        type=str, action="append")
+    parser.add_argument("--plan", action="store_true",
+                        help="check the moves against the project's files, print the order they'll be made in and the files each will update, and exit")
+    parser.add_argument("--diff", "--dry-run", help="don't write any files, print a unified diff of the changes to stdout instead", action="store_true")
+    parser.add_argument("--report", help="print a record of each edit, warning and error to stdout as JSON Lines as each file is done",
+                        choices=['json'])
+    parser.add_argument("--strings", help="also find old paths in string literals, eg mock.patch() targets, and anywhere in config files "
+                        "(%s), and update them, or only report them as warnings" % ', '.join(CONFIG_FILES), choices=['update', 'report'])
+    parser.add_argument("--verify", action="store_true",
+                        help="check each file's new code compiles and that its new imports are in the project (see --root) before writing it, "
+                        "and leave any that fail as they were")
+    parser.add_argument("--journal", help="record the moves and each file done in this file as the run goes, so it can be resumed with --resume",
+                        type=str, metavar="FILE")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip files the --journal has as done and unchanged since, unless it's for different moves, in which case start over")
+    parser.add_argument("--cache-dir", help="cache files' imports in this dir so unchanged files can be skipped without parsing them on later runs", type=str)
+    parser.add_argument("--cache-size", help="max size of the cache dir in MB (default 64)", type=int, default=64)
+    parser.add_argument("--engine", help="how to parse and update files: 'fast' uses the stdlib and falls back to 'redbaron' for code the stdlib can't parse (default fast)",
+                        choices=['fast', 'redbaron'], default='fast')
+    parser.add_argument("--stats", help="print time spent per phase and the N slowest files (default 10) to stderr when done",
+                        type=int, nargs="?", const=10, metavar="N")
+    parser.add_argument("--profile", help="write cProfile stats for the run to this file", type=str)
+    parser.add_argument("--index", help="keep a reverse import index of the project in this file, and only process files it says import something moved", type=str)
+    parser.add_argument("--who-imports", help="print file:line for each import of this module or symbol, or anything under it, and exit", type=str, metavar="NAME")
+    parser.add_argument("--serve", action="store_true",
+                        help="keep running, reading moves from stdin as JSON lines like {\"moves\": [[\"from.here\", \"to.here\"]]} and writing a JSON result line for each")
+    parser.add_argument("--socket", help="like --serve, but read moves from connections to a unix socket at this path", type=str)
+    parser.add_argument("--max-trees", help="with --serve or --socket, the number of parsed files to keep in memory (default 1000)", type=int, default=1000)
+    parser.add_argument("-m", "--move", help="a package/module/symbol move in the form of 'from.here,to.here'; can be given more than once", type=move_arg, action="append")
+    parser.add_argument("--moves-file", help="a file of moves, either JSON (a list of [from, to] pairs or a {from: to} object) or CSV with 'from,to' rows", type=str)
     parser.add_argument("path", nargs="*", default="./", help="path to run on", type=str)
     args = parser.parse_args()
+    if not args.move and not args.moves_file and not args.who_imports and not args.serve and not args.socket:
+        parser.error("at least one of --move or --moves-file is required")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.diff and args.report:
+        parser.error("--diff and --report can't both be used since both print to stdout")
+    if args.resume and not args.journal:
+        parser.error("--resume needs a --journal to resume from")
+    if args.journal and args.diff:
+        parser.error("--journal can't be used with --diff since no files are changed")
+    if args.engine == 'redbaron' and not have_redbaron():
+        parser.error("the redbaron engine needs redbaron, which isn't installed")
     return args
 
 
+def move_arg(s):
+    move = [x.strip() for x in s.split(',')]
+    if len(move) != 2 or not all(move):
+        raise argparse.ArgumentTypeError("expected 'from.here,to.here' but got %r" % s)
+    return tuple(move)
+
+
+def load_moves_file(path):
+    """Return the list of (old, new) moves in the file at path. Files ending in
+    .json hold a list of [old, new] pairs or an object mapping old paths to new
+    ones. Anything else is read as CSV with an old,new pair per row, skipping
+    blank rows and rows starting with #."""
+    with open(path, 'r') as f:
+        if path.endswith('.json'):
+            data = json.load(f)
+            if isinstance(data, dict):
+                data = list(data.items())
+            moves = []
+            for move in data:
+                if not isinstance(move, (list, tuple)) or len(move) != 2 or not all(isinstance(p, str) for p in move):
+                    raise ValueError("%s: expected [old, new] pairs of strings but got %r" % (path, move))
+                moves.append(tuple(move))
+            return moves
+        moves = []
+        for lineno, row in enumerate(csv.reader(f), 1):
+            if not row or not ''.join(row).strip() or row[0].lstrip().startswith('#'):
+                continue
+            if len(row) != 2:
+                raise ValueError("%s:%d: expected old,new but got %r" % (path, lineno, ','.join(row)))
+            moves.append((row[0], row[1]))
+        return moves
+
+
 def parse_moves(moves):
-    ModPath = namedtuple('ModPath', ['full', 'except_last', 'last'])
+    """Parse (old, new) dotted path pairs into [old, new] ModPath pairs, in the
+    order given by order_moves(). Raises ValueError if a path isn't a valid
+    dotted name, is moved to more than one place, or if more than one path is
+    moved to the same place. Moves of a path to itself are dropped. All moves
+    are applied in a single pass over each file, so a move to somewhere that's
+    itself moved by another move (a -> b and b -> c) isn't followed; that's
+    logged."""
     parsed = []
+    dests = {}
+    sources = {}
     for old, new in moves:
-        o = old.rsplit('.', 1)
-        if len(o) == 1:
-            oldel, oldl = o, None
-        else:
-            oldel, oldl = o
-        n = new.rsplit('.', 1)
-        if len(n) == 1:
-            newel, newl = n, None
-        else:
-            newel, newl = n
-        parsed.append([ModPath(old, oldel, oldl), ModPath(new, newel, newl)])
+        old, new = old.strip(), new.strip()
+        for path in (old, new):
+            if not all(part.isidentifier() and not keyword.iskeyword(part) for part in path.split('.')):
+                raise ValueError("%r isn't a dotted module path" % path)
+        if old in dests:
+            if dests[old] != new:
+                raise ValueError("conflicting moves of %s to %s and to %s" % (old, dests[old], new))
+            continue
+        if new in sources:
+            raise ValueError("conflicting moves of %s and %s to %s" % (sources[new], old, new))
+        if old == new:
+            log.warning("Ignoring move of %s to itself", old)
+            continue
+        dests[old] = new
+        sources[new] = old
+        parsed.append([_mod_path(old), _mod_path(new)])
+    parsed, cycles = order_moves(parsed)
+    in_cycles = set(old.full for cycle in cycles for old, new in cycle)
+    for cycle in cycles:
+        log.warning("Moves %s form a cycle; they're applied together so they swap places",
+                    ', '.join('%s -> %s' % (old.full, new.full) for old, new in cycle))
+    for old, new in parsed:
+        for other in _overlapping(parsed, new.full):
+            if other != old.full and not (old.full in in_cycles and other in in_cycles):
+                log.warning("Move %s -> %s is chained with move %s -> %s; imports are only updated once so what's moved to %s won't be moved again",
+                            old.full, new.full, other, dests[other], new.full)
     log.debug("Parsed moves: %r", parsed)
     return parsed
 
 
-def recurse(path, hidden_dirs=False, exclude=None):
-    """If path is a directory, recurse into it and return a list of paths.
-    If path is a file, return a singleton list with that path.  If hidden_dirs
-    is true, recurse into hidden dirs.  Exclude is something with a truthy "search"
-    function that, if it returns true, will exclude dirs or files."""
-    if isinstance(path, list):
-        r = []
+def _overlapping(moves, name):
+    """Return the old paths of moves that name is under or that are under it."""
+    return [old.full for old, new in moves if (name + '.').startswith(old.full + '.') or old.full.startswith(name + '.')]
+
+
+def order_moves(moves):
+    """Order [old, new] ModPath pairs so that making the moves one at a time in
+    that order would give the same result as making them all at once, which
+    is how they're applied: a move out of somewhere comes before any move
+    into it. Moves that can't be ordered that way form cycles, like a -> b
+    and b -> a, which are left at the end. Returns the ordered moves and a
+    list of the cycles, each a list of moves. Otherwise the given order is
+    kept."""
+    # before[i] = moves that have to come before move i: the ones out of where it moves to
+    index = {old.full: i for i, (old, new) in enumerate(moves)}
+    before = [set(index[other] for other in _overlapping(moves, new.full) if index[other] != i) for i, (old, new) in enumerate(moves)]
+    ordered = []
+    done = set()
+    remaining = list(range(len(moves)))
+    while remaining:
+        ready = [i for i in remaining if before[i] <= done]
+        if not ready:
+            break
+        ordered.extend(ready)
+        done.update(ready)
+        remaining = [i for i in remaining if i not in done]
+    cycles = []
+    for i in _cycles(remaining, before):
+        cycles.append([moves[j] for j in i])
+    return [moves[i] for i in ordered + remaining], cycles
+
+
+def _cycles(nodes, before):
+    """Return the strongly connected components with more than one node of the
+    graph of nodes with edges i -> before[i], each a sorted list."""
+    nodes = set(nodes)
+    components = []
+    seen = set()
+    for start in sorted(nodes):
+        if start in seen:
+            continue
+        # Everything reachable from start that can also reach it back.
+        reach = _reachable(start, lambda i: before[i] & nodes)
+        back = _reachable(start, lambda i: set(j for j in nodes if i in before[j]))
+        component = sorted(reach & back)
+        seen.update(component)
+        if len(component) > 1:
+            components.append(component)
+    return components
+
+
+def _reachable(start, edges):
+    found = set([start])
+    stack = [start]
+    while stack:
+        for j in edges(stack.pop()):
+            if j not in found:
+                found.add(j)
+                stack.append(j)
+    return found
+
+
+def _mod_path(path):
+    if '.' in path:
+        except_last, last = path.rsplit('.', 1)
+    else:
+        except_last, last = '', path
+    return ModPath(path, except_last, last)
+
+
+class MoveIndex(object):
+    """Index over parsed moves, keyed by dotted component, that finds the move
+    with the longest old path matching a name in time proportional to the
+    name's depth. Only whole components match, so a move of pkg1 doesn't match
+    pkg10.foo. Iterating over it gives the moves it was built from. It also
+    holds (name, move) pairs from ModuleResolver.reexports(), which are
+    matched the same way by find_reexport()."""
+
+    def __init__(self, moves, reexports=()):
+        self.moves = list(moves)
+        self.trie = {}
+        for old, new in self.moves:
+            self._insert(self.trie, old.full, (old, new))
+        self.reexports = {}
+        for name, move in reexports:
+            self._insert(self.reexports, name, (name, move))
+
+    @staticmethod
+    def _insert(trie, name, value):
+        node = trie
+        for part in name.split('.'):
+            node = node.setdefault(part, {})
+        node[None] = value
+
+    @staticmethod
+    def _find(trie, name):
+        found = None
+        node = trie
+        for part in name.split('.'):
+            node = node.get(part)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def __iter__(self):
+        return iter(self.moves)
+
+    def __len__(self):
+        return len(self.moves)
+
+    def find(self, name):
+        """Return the (old, new) move whose old path is name or the longest
+        dotted prefix of it, or None if there isn't one."""
+        return self._find(self.trie, name)
+
+    def find_reexport(self, name):
+        """Return the (re-exported name, move) whose re-exported name is name or
+        the longest dotted prefix of it, or None if there isn't one."""
+        return self._find(self.reexports, name)
+
+
+# Config files that can hold dotted paths, eg entry points in setup.cfg.
+CONFIG_FILES = ('.cfg', '.ini', '.toml')
+
+
+def recurse(path, hidden_dirs=False, exclude=None, git=False, config=False):
+    """If path is a directory, recurse into it and yield the paths of the .py
+    files in it. If path is a file, yield just that path. path can also be a
+    list of paths. If hidden_dirs is true, recurse into hidden dirs. Exclude is
+    something with a truthy "search" function that, if it returns true for the
+    name of a dir or file found under path, will exclude it. If git is true,
+    files come from `git ls-files` instead of walking dirs, which also skips
+    files git ignores. If config is true, config files (see CONFIG_FILES) are
+    yielded too. It's a generator so files can be processed while it's still
+    walking dirs."""
+    if isinstance(path, (list, tuple)):
         for p in path:
-            r += recurse(p)
-        return r
+            for f in recurse(p, hidden_dirs=hidden_dirs, exclude=exclude, git=git, config=config):
+                yield f
+        return
 
     if os.path.isfile(path):
-        return [path]
+        yield path
+        return
+
+    if git:
+        try:
+            files = _git_files(path, config)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning("Can't list files in %s with git, walking it instead: %s", path, e)
+        else:
+            for fname in files:
+                parts = fname.split('/')
+                if not all(_walk_dir(d, hidden_dirs, exclude) for d in parts[:-1]):
+                    continue
+                if exclude and exclude.search(parts[-1]):
+                    continue
+                fpath = os.path.join(path, *parts)
+                if os.path.isfile(fpath):
+                    yield fpath
+            return
 
-    paths = []
-    for dirpath, dirnames, fnames in os.walk(path):
-        rm = set()
-        if not hidden_dirs:
-            rm.update({d for d in dirnames if d.startswith(".")})
-        if exclude:
-            rm.update({d for d in dirnames if exclude.search(d)})
-        for d in rm:
-            dirnames.remove(d)
+    dirs = [path]
+    while dirs:
+        dirpath = dirs.pop()
+        try:
+            entries = sorted(os.scandir(dirpath), key=lambda e: e.name)
+        except OSError as e:
+            log.warning("Can't list %s: %s", dirpath, e)
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if _walk_dir(entry.name, hidden_dirs, exclude):
+                    subdirs.append(entry.path)
+            elif (entry.name.endswith(".py") or config and entry.name.endswith(CONFIG_FILES)) and not (exclude and exclude.search(entry.name)):
+                yield entry.path
+        dirs.extend(reversed(subdirs))
 
-        for fname in fnames:
-            if fname.endswith(".py"):
-                paths.append(os.path.join(dirpath, fname))
 
-    return paths
+def _walk_dir(name, hidden_dirs, exclude):
+    if not hidden_dirs and name.startswith("."):
+        return False
+    return not (exclude and exclude.search(name))
 
 
-def update_imports(paths, moves):
-    for path in paths:
+def _git_files(path, config=False):
+    """Return the paths, relative to path and with / separators, of the .py
+    files (and config files if config is true) git tracks or could track (ie
+    that aren't ignored) in path."""
+    patterns = ['*.py'] + ['*' + ext for ext in CONFIG_FILES if config]
+    out = subprocess.check_output(['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard', '--'] + patterns,
+                                  cwd=path, stderr=subprocess.PIPE)
+    return sorted(set(f.decode('utf-8', 'surrogateescape') for f in out.split(b'\0') if f))
+
+
+def git_changed(path, revs, roots, hidden_dirs=False, exclude=None):
+    """Yield the paths of the .py files in path that git says were added or
+    modified in revs, followed by the files that import any module added,
+    modified, deleted or renamed in revs, as found under roots (see
+    ModuleResolver). revs is anything `git diff` takes, eg a range like
+    main..HEAD, or a single revision to compare the working tree with. path
+    can also be a list of paths. Files are skipped for hidden_dirs and exclude
+    the same way recurse() skips them. Falls back to recurse() if git fails,
+    since what changed can't be known then."""
+    if not isinstance(path, (list, tuple)):
+        path = [path]
+    resolver = ModuleResolver(roots)
+    changed = []
+    candidates = []
+    try:
+        for p in path:
+            if os.path.isfile(p):
+                continue
+            modified, removed = _git_changes(p, revs)
+            modules = set()
+            for fname in modified + removed:
+                name = resolver.module_name(os.path.join(p, *fname.split('/')))
+                if name:
+                    modules.add(name)
+            changed.extend((p, fname, None) for fname in modified)
+            if modules:
+                grep = _git_grep(p, set(name.rpartition('.')[2] for name in modules))
+                candidates.extend((p, fname, modules) for fname in grep)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning("Can't get the files changed in %s with git, processing all of them instead: %s", revs, e)
+        for f in recurse(path, hidden_dirs=hidden_dirs, exclude=exclude, git=True):
+            yield f
+        return
+
+    seen = set()
+    for p in path:
+        if os.path.isfile(p) and p not in seen:
+            seen.add(p)
+            yield p
+    for p, fname, modules in changed + candidates:
+        parts = fname.split('/')
+        if not all(_walk_dir(d, hidden_dirs, exclude) for d in parts[:-1]) or (exclude and exclude.search(parts[-1])):
+            continue
+        fpath = os.path.join(p, *parts)
+        if fpath in seen or not os.path.isfile(fpath):
+            continue
+        if modules:
+            # git grep only found a changed module's name, so check it's imported
+            with open(fpath, 'rb') as f:
+                imports = file_imports(fpath, f.read())
+            if imports is not None and not any(_under(name, modules) for name, line in imports):
+                continue
+        seen.add(fpath)
+        yield fpath
+
+
+def _under(name, modules):
+    """Return whether name is one of modules or under one of them."""
+    parts = name.split('.')
+    return any('.'.join(parts[:i]) in modules for i in range(1, len(parts) + 1))
+
+
+def _git_changes(path, revs):
+    """Return lists of the paths, relative to path and with / separators, of
+    the .py files in path that were added or modified in revs, and of ones
+    that were deleted or renamed away."""
+    out = subprocess.check_output(['git', 'diff', '--name-status', '-z', '-M', '--relative', revs, '--', '*.py'],
+                                  cwd=path, stderr=subprocess.PIPE)
+    fields = [f.decode('utf-8', 'surrogateescape') for f in out.split(b'\0') if f]
+    changed = []
+    removed = []
+    i = 0
+    while i < len(fields):
+        status = fields[i][0]
+        if status in 'RC':
+            if status == 'R':
+                removed.append(fields[i + 1])
+            changed.append(fields[i + 2])
+            i += 3
+            continue
+        (removed if status == 'D' else changed).append(fields[i + 1])
+        i += 2
+    return changed, removed
+
+
+def _git_grep(path, words):
+    """Return the paths, relative to path and with / separators, of the .py
+    files git tracks or could track in path that contain any of words."""
+    args = ['git', 'grep', '-l', '-z', '-I', '-w', '-F', '--untracked']
+    for word in sorted(words):
+        args.extend(['-e', word])
+    proc = subprocess.run(args + ['--', '*.py'], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode not in (0, 1): # 1 means nothing matched
+        raise subprocess.CalledProcessError(proc.returncode, args, proc.stdout, proc.stderr)
+    return sorted(f.decode('utf-8', 'surrogateescape') for f in proc.stdout.split(b'\0') if f)
+
+
+def update_imports(paths, moves, jobs=1, cache=None, engine='fast', stats=None, diff_out=None, max_rss=None, large_file=None,
+                   report_out=None, strings=None, journal=None, verify=None):
+    """Update imports in the files in paths, using jobs processes if it's more
+    than 1. Results are handled in the order of paths either way, and each
+    file is processed once even if it's in paths more than once. If cache (an
+    ImportCache) is given, it's used to skip files without parsing them when
+    their imports are known. See update_imports_file() for engine. If stats
+    (a RunStats) is given, timings and counts for the run are added to it.
+    If diff_out (a text file) is given, no files are written and a unified
+    diff of the changes is written to it instead, a file at a time as each
+    is done. If max_rss is given, files are processed in worker processes
+    (even if jobs is 1) that are replaced once they use more than max_rss
+    bytes of memory. See update_imports_file() for large_file. If report_out
+    (a text file) is given, a JSON record of each edit (see
+    update_imports_file()), warning and error is written to it per line, a
+    file at a time as each is done. If strings (a PathScanner) is given, old
+    paths in string literals are updated too, as are those anywhere in paths
+    that aren't .py files, eg config files. If journal (a Journal) is given,
+    each file done is recorded in it, and files it already has as done are
+    skipped. If verify (a ModuleResolver) is given, each file's new code is
+    checked before it's written, by the worker processes if there are any,
+    and files that fail are left as they were and counted as errors (see
+    update_imports_file()). Returns a list of (path, error message) for files
+    that couldn't be processed."""
+    if not isinstance(moves, MoveIndex):
+        moves = MoveIndex(moves)
+    work = partial(_process_file, moves=moves, heads=move_heads(moves), cache=cache, engine=engine, diff=diff_out is not None,
+                   large_file=large_file, report=report_out is not None, strings=strings, digest=journal is not None,
+                   verify=verify)
+    paths = _unique_paths(paths, stats)
+    if journal:
+        paths = journal.unfinished(paths)
+    if max_rss:
+        pool = None
+        results = _recycling_imap(work, paths, jobs, max_rss)
+    elif jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(work, paths, chunksize=8)
+    else:
+        pool = None
+        results = map(work, paths)
+
+    scanned = skipped = cached = modified = 0
+    errors = []
+    try:
+        for res in results:
+            scanned += 1
+            if stats:
+                stats.add(res)
+            if res.status == 'skipped':
+                skipped += 1
+                log.debug("%s ... skipped, no imports could match", res.path)
+            elif res.status == 'cached':
+                cached += 1
+                log.debug("%s ... skipped, no cached imports match", res.path)
+            elif res.status == 'error':
+                errors.append((res.path, res.error))
+                log.error("%s ... failed: %s", res.path, res.error)
+            else:
+                if res.status == 'modified':
+                    modified += 1
+                    if res.diff:
+                        diff_out.write(res.diff)
+                        diff_out.flush()
+                log.info("%s ... %s %0.3f", res.path, res.status, res.elapsed)
+            if report_out:
+                _write_report(report_out, res)
+            if journal and res.digest:
+                journal.record(res.path, res.digest)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        elif max_rss:
+            results.close()
+    if cache:
+        cache.prune()
+    log.info("%s %d of %d files scanned (skipped %d without any possibly matching imports and %d by cached imports)",
+             "Would modify" if diff_out else "Modified", modified, scanned, skipped, cached)
+    if journal and journal.resumed:
+        log.info("Skipped %d files already done according to the journal", journal.resumed)
+    if errors:
+        log.warning("Failed to update %d files", len(errors))
+    return errors
+
+
+def _unique_paths(paths, stats=None):
+    """Yield each of paths once. A symlink is yielded as the path of the file
+    it points to, so relative imports are resolved from where the module
+    really is. The time spent getting them from paths is added to stats'
+    discover phase since it's typically a generator that's still walking
+    directories."""
+    seen = set()
+    paths = iter(paths)
+    while True:
         t0 = time.time()
-        update_imports_file(path, moves)
-        td = time.time() - t0
-        log.info("%s ... %0.3f", path, td)
+        path = next(paths, None)
+        if stats:
+            stats.times['discover'] += time.time() - t0
+        if path is None:
+            return
+        key = os.path.realpath(path)
+        if key not in seen:
+            seen.add(key)
+            yield os.path.relpath(key) if os.path.islink(path) else path
 
 
-def update_imports_file(path, moves):
-    with open(path, 'r') as f:
-        ast = RedBaron(f.read())
-    update_imports_ast(path, ast, moves)
-    with open(path, 'w') as f:
-        f.write(ast.dumps())
+def _recycling_imap(work, items, jobs, max_rss):
+    """Like multiprocessing.Pool(jobs).imap(work, items), but a worker process
+    using more than max_rss bytes of memory after an item is replaced by a
+    new one, so whatever it's holding on to is given back. A worker that dies,
+    eg killed for using too much memory, is replaced too, and the result for
+    its item is an error FileResult."""
+    items = enumerate(items)
+    workers = {} # connection -> [process, index of the item it's on or None]
+    paths = {} # index -> item for items sent to workers
+    results = {} # index -> result for results not yet yielded
+    next_index = 0
+    exhausted = False
+    try:
+        while True:
+            while len(workers) < jobs:
+                conn, child_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_recycling_worker, args=(work, child_conn, max_rss), daemon=True)
+                process.start()
+                child_conn.close()
+                workers[conn] = [process, None]
+            for conn, worker in workers.items():
+                if worker[1] is None and not exhausted and len(results) < jobs * 4:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    paths[item[0]] = item[1]
+                    conn.send(item)
+                    worker[1] = item[0]
+            while next_index in results:
+                paths.pop(next_index)
+                yield results.pop(next_index)
+                next_index += 1
+            busy = [conn for conn, worker in workers.items() if worker[1] is not None]
+            if not busy:
+                return
+            ready = wait(busy + [workers[conn][0].sentinel for conn in busy])
+            for conn in busy:
+                process, index = workers[conn]
+                if conn in ready:
+                    try:
+                        res, rss = conn.recv()
+                    except EOFError:
+                        pass
+                    else:
+                        results[index] = res
+                        workers[conn][1] = None
+                        if rss <= max_rss:
+                            continue
+                        log.debug("Replacing worker process %d using %d MB", process.pid, rss // (1024 * 1024))
+                        index = None
+                elif process.sentinel not in ready:
+                    continue
+                process.join()
+                conn.close()
+                del workers[conn]
+                if index is not None:
+                    results[index] = FileResult(paths[index], 'error', 0.0,
+                                                "worker process died with exit code %s, eg from running out of memory" % process.exitcode, Stats())
+    finally:
+        for conn, (process, index) in workers.items():
+            conn.close()
+            process.terminate()
+            process.join()
 
 
-def update_imports_ast(path, ast, moves):
-    log.debug("Processing file %s", path)
+def _recycling_worker(work, conn, max_rss):
+    """Run work on items from conn until it's closed or this process uses
+    more than max_rss bytes of memory."""
+    while True:
+        try:
+            index, item = conn.recv()
+        except EOFError:
+            return
+        res = work(item)
+        rss = current_rss()
+        conn.send((res, rss))
+        if rss > max_rss:
+            return
+
+
+def current_rss():
+    """Return how many bytes of memory this process is using, or its peak
+    use if that isn't available, or 0 if neither is."""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        if resource is None:
+            return 0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024 # bytes on macOS, kB elsewhere
+
+
+def _write_report(out, res):
+    """Write the report records for res, a FileResult, to out as JSON Lines."""
+    records = [dict(type='edit', file=res.path, **edit) for edit in res.report[0]] if res.report else []
+    if res.report:
+        records.extend({'type': 'warning', 'file': res.path, 'message': message} for message in res.report[1])
+    if res.error:
+        records.append({'type': 'error', 'file': res.path, 'message': res.error})
+    for record in records:
+        out.write(json.dumps(record) + '\n')
+    if records:
+        out.flush()
+
+
+def _process_file(path, moves, heads, cache=None, engine='fast', diff=False, large_file=None, report=False, strings=None, digest=False,
+                  verify=None):
+    """Update imports in one file, returning a FileResult rather than raising
+    so one bad file doesn't stop a whole run. Runs in worker processes. If
+    report is true, the FileResult's report is ([edit record, ...], [warning
+    message, ...]) for the file. Files other than .py files only have paths
+    that strings (a PathScanner, or None) finds updated. If digest is true,
+    the FileResult's digest is the file_digest() of its contents once it's
+    done. See update_imports_file() for verify."""
+    t0 = time.time()
+    stats = Stats()
+    edits = [] if report else None
+    with _captured_warnings(report) as warnings:
+        try:
+            with stats.timer('read'):
+                with open(path, 'rb') as f:
+                    source = f.read()
+            with stats.timer('filter'):
+                has_strings = strings is not None and strings.search(source)
+                if not path.endswith('.py') or not may_need_update(path, source, heads):
+                    if not has_strings:
+                        return FileResult(path, 'skipped', time.time() - t0, None, stats, digest=file_digest(source) if digest else None)
+                    cache = None # it only knows about imports
+                if cache and not has_strings:
+                    table = cache.get(path, source)
+                    if table is not None:
+                        if not import_table_matches(table, moves):
+                            return FileResult(path, 'cached', time.time() - t0, None, stats, digest=file_digest(source) if digest else None)
+                        # Already cached so there's no need to cache it again.
+                        cache = None
+            if not path.endswith('.py'):
+                changed = update_strings_file(path, strings, source, stats=stats, diff=diff, report=edits)
+            else:
+                changed = update_imports_file(path, moves, source, cache=cache, engine=engine, stats=stats, diff=diff, large_file=large_file,
+                                              report=edits, strings=strings, verify=verify)
+            if digest and changed and not diff:
+                with open(path, 'rb') as f:
+                    source = f.read()
+        except Exception as e:
+            log.debug("Error processing %s", path, exc_info=True)
+            return FileResult(path, 'error', time.time() - t0, "%s: %s" % (type(e).__name__, e), stats,
+                              report=(edits, warnings) if report else None)
+    return FileResult(path, 'modified' if changed else 'unchanged', time.time() - t0, None, stats,
+                      changed if diff and changed else None, (edits, warnings) if report else None, file_digest(source) if digest else None)
+
+
+class _CaptureHandler(logging.Handler):
+    """Logging handler that appends the messages of records to the list that
+    _captured_warnings() set for the thread logging them, if any."""
+
+    def emit(self, record):
+        messages = getattr(_captured, 'messages', None)
+        if messages is not None:
+            messages.append(record.getMessage())
+
+
+_captured = threading.local()
+_capture_handler = _CaptureHandler(logging.WARNING)
+
+
+@contextmanager
+def _captured_warnings(capture=True):
+    """Yield a list of the messages of warnings logged by this thread while in
+    the block, or if capture is false, an empty list. The one handler is left
+    on the logger once added, rather than added and removed by each call,
+    since removing one while other threads log can make them skip theirs."""
+    messages = []
+    if not capture:
+        yield messages
+        return
+    log.addHandler(_capture_handler) # does nothing if it's already there
+    outer = getattr(_captured, 'messages', None)
+    _captured.messages = messages
+    try:
+        yield messages
+    finally:
+        _captured.messages = outer
+
+
+class Stats(object):
+    """Time spent in each phase of updating imports, counts of import
+    statements examined and imports updated, and the most memory used at the
+    end of a phase, for a file or a whole run."""
+
+    PHASES = ['discover', 'read', 'filter', 'parse', 'transform', 'dump', 'verify', 'write']
+
+    def __init__(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.imports = 0
+        self.edits = 0
+        self.peak_rss = 0
+
+    @contextmanager
+    def timer(self, phase):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.times[phase] += time.time() - t0
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+
+class RunStats(Stats):
+    """Stats for a whole run that also tracks the slowest files and the
+    files that used the most memory."""
+
+    def __init__(self, slowest=10):
+        super(RunStats, self).__init__()
+        self.files = 0
+        self.slowest_n = slowest
+        self.slowest = [] # min heap of (seconds, path)
+        self.largest = [] # min heap of (peak rss, path)
+
+    def add(self, res):
+        """Add the stats of res, a FileResult."""
+        self.files += 1
+        for phase, t in res.stats.times.items():
+            self.times[phase] += t
+        self.imports += res.stats.imports
+        self.edits += res.stats.edits
+        self.peak_rss = max(self.peak_rss, res.stats.peak_rss)
+        for heap, item in [(self.slowest, (res.elapsed, res.path)), (self.largest, (res.stats.peak_rss, res.path))]:
+            if len(heap) < self.slowest_n:
+                heapq.heappush(heap, item)
+            elif self.slowest_n:
+                heapq.heappushpop(heap, item)
+
+    def report(self, out):
+        total = sum(self.times.values())
+        out.write("Phase          Seconds       %\n")
+        for phase in self.PHASES:
+            out.write("%-10s %11.3f %7.1f\n" % (phase, self.times[phase], 100 * self.times[phase] / total if total else 0))
+        out.write("%-10s %11.3f\n" % ('total', total))
+        out.write("%d files, %d import statements examined, %d imports updated\n" % (self.files, self.imports, self.edits))
+        if self.slowest:
+            out.write("Slowest files:\n")
+            for elapsed, path in sorted(self.slowest, reverse=True):
+                out.write("%11.3f  %s\n" % (elapsed, path))
+        if self.peak_rss:
+            out.write("Peak memory %.1f MB, most used by:\n" % (self.peak_rss / (1024 * 1024)))
+            for rss, path in sorted(self.largest, reverse=True):
+                out.write("%8.1f MB  %s\n" % (rss / (1024 * 1024), path))
+
+
+# Matches the module part of an import statement in raw source: the lhs of a
+# "from x import y" or everything up to the end of the line (or a ';' or
+# comment) of an "import x, y.z". It's deliberately loose since it also matches
+# in strings and comments; false positives only cost a parse.
+_IMPORT_RE = re.compile(
+    br'\bfrom[ \t]*(\.*[\w.\x80-\xff]*)[ \t]*(?:\\\r?\n[ \t]*)?import\b'
+    br'|\bimport[ \t]+((?:[^\r\n;#\\]|\\\r?\n)+)')
+
+
+def move_heads(moves):
+    """Return the set of first components of the old paths of moves."""
+    return {old.full.split('.', 1)[0] for old, new in moves}
+
+
+def may_need_update(path, source, heads):
+    """Cheaply check whether raw source (bytes) of the file at path could
+    contain an import that some move affects, ie whether any import's module
+    path (relative ones resolved with abs_mod_path) starts with one of heads.
+    This can have false positives but never false negatives so files for which
+    it returns false can safely be skipped without parsing them."""
+    if b'import' not in source:
+        return False
+    for m in _IMPORT_RE.finditer(source):
+        frm, names = m.groups()
+        if frm is not None:
+            mods = [frm]
+        else:
+            names = names.replace(b'\\\n', b' ').replace(b'\\\r', b' ')
+            mods = [n.split()[0] for n in names.split(b',') if n.strip()]
+        for mod in mods:
+            mod = mod.decode('utf-8', 'replace')
+            if mod.startswith('.'):
+                mod = abs_mod_path(path, mod)
+            if mod.split('.', 1)[0] in heads:
+                return True
+    return False
+
+
+class PathScanner(object):
+    """Finds the old paths of moves in text, eg in strings like
+    mock.patch('pkg.mod.func'), in one pass however many moves there are.
+    It's an automaton over the characters of all the old paths (a trie),
+    walked from the start of each dotted name in the text that could begin
+    one; a regex finds those, so the text in between is skipped at C speed.
+    A path only matches a whole dotted name or the part of one before a dot
+    or colon, so a match can't start inside another one, and the failure
+    links of a full Aho-Corasick automaton aren't needed. The longest old
+    path wins, as with MoveIndex. A top level name on its own is too common a
+    word to be taken for a module, so it only matches when followed by a dot
+    or colon. If rewrite is false, update_strings() only reports what it
+    finds."""
+
+    def __init__(self, moves, rewrite=True):
+        self.rewrite = rewrite
+        self.trie = {} # char -> node, and None -> (move, whether it needs a dot or colon after it) at the end of an old path
+        for old, new in moves:
+            node = self.trie
+            for char in old.full:
+                node = node.setdefault(char, {})
+            node[None] = ((old, new), '.' not in old.full)
+        self.starts = re.compile(r'(?<![\w.])[%s]' % re.escape(''.join(sorted(self.trie)))) if self.trie else None
+
+    def find(self, text):
+        """Yield (start, end, move) for each old path at text[start:end]."""
+        if not self.starts:
+            return
+        pos = 0
+        while True:
+            m = self.starts.search(text, pos)
+            if not m:
+                return
+            start = pos = m.start()
+            node = self.trie
+            found = None
+            while pos < len(text):
+                node = node.get(text[pos])
+                if node is None:
+                    break
+                pos += 1
+                if None in node:
+                    after = text[pos] if pos < len(text) else ''
+                    move, dotted_only = node[None]
+                    if (after and after in '.:') if dotted_only else not (after.isalnum() or after == '_'):
+                        found = (pos, move)
+            if found:
+                yield start, found[0], found[1]
+                pos = found[0]
+            else:
+                pos = start + 1
+
+    def search(self, source):
+        """Return whether raw source (bytes) contains any old path."""
+        return next(self.find(source.decode('latin-1')), None) is not None
 
-    # import each parent and see if it includes the child. if so add those
-    # module paths to a warning list to flag (but not update) if seen.
+
+def update_strings(path, code, scanner, report=None, python=True):
+    """Update the old paths of moves that scanner (a PathScanner) finds in
+    code, the source of the file at path, to their new ones: in its string
+    literals if python is true, or anywhere in it otherwise, eg in config
+    files. Returns the new code and the number of paths updated. If
+    scanner.rewrite is false, each one is logged as a warning instead and
+    code is returned as it is. If report (a list) is given, a record of each
+    update is appended to it (see update_imports_file())."""
+    found = list(scanner.find(code))
+    if not found:
+        return code, 0
+    lines = _SourceLines(code)
+    if python:
+        strings = []
+        try:
+            for tok in _generate_tokens(code):
+                if tok.type == tokenize.STRING or tok.type == getattr(tokenize, 'FSTRING_MIDDLE', None):
+                    strings.append((lines.offset(*tok.start), lines.offset(*tok.end)))
+        except SyntaxError as e:
+            log.warning("%s: can't find its strings to update paths in them: %s", path, e)
+            return code, 0
+        starts = [start for start, end in strings]
+        found = [(start, end, move) for start, end, move in found
+                 if bisect.bisect_right(starts, start) and end <= strings[bisect.bisect_right(starts, start) - 1][1]]
+    chunks = []
+    pos = 0
+    for start, end, (old, new) in found:
+        line = bisect.bisect_right(lines.starts, start)
+        if not scanner.rewrite:
+            log.warning("%s:%d: reference to %s, which is moved to %s", path, line, old.full, new.full)
+            continue
+        if report is not None:
+            report.append(_edit_record(line, old.full, new.full, [(old, new)]))
+        chunks.extend([code[pos:start], new.full])
+        pos = end
+    if not chunks:
+        return code, 0
+    chunks.append(code[pos:])
+    return ''.join(chunks), len(chunks) // 2
+
+
+def update_imports_file(path, moves, source=None, cache=None, engine='fast', stats=None, parsed=None, diff=False, large_file=None,
+                        report=None, strings=None, verify=None):
+    """Update imports in the file at path, whose raw contents can be passed as
+    source if they've already been read, or whose ParsedFile from parse_file()
+    can be passed as parsed if it's already been parsed (in which case a
+    RedBaron tree in it is updated in place). The file is only rewritten if that
+    changes it, and then atomically. If cache (an ImportCache) is given, the
+    file's imports are stored in it. engine 'fast' uses update_imports_code()
+    and falls back to RedBaron for code the stdlib can't parse, and engine
+    'redbaron' uses update_imports_ast(). Files bigger than large_file bytes
+    only have their import statements parsed, using the fast engine whatever
+    engine is, to bound the memory used for them. If report (a list) is given,
+    a record of each edit is appended to it, a dict of the 'line' it's on,
+    the 'old' and 'new' code, and the 'moves' applied as [old, new] pairs.
+    If strings (a PathScanner) is given, old paths in string literals are
+    updated too, see update_strings(). If verify (a ModuleResolver) is given,
+    the new code is checked with verify_update() before it's written, and if
+    that fails the file is left as it was and VerificationError is raised.
+    If stats (a Stats) is given, the time spent in each phase is added to it.
+    Returns whether it was rewritten, or if diff is true, leaves the file
+    alone and returns a unified diff of the change, which is empty if there's
+    none."""
+    if stats is None:
+        stats = Stats()
+    if source is None and parsed is None:
+        with stats.timer('read'):
+            with open(path, 'rb') as f:
+                source = f.read()
+    if parsed is None:
+        with stats.timer('parse'):
+            parsed = parse_file(path, source, engine, import_only=large_file is not None and len(source) > large_file)
+    code, encoding, ast, import_only = parsed
+    if cache or verify:
+        table = import_table(path, ast)
+    if cache:
+        cache.put(path, source, table)
+
+    new_code = update_imports_parsed(path, moves, parsed, stats=stats, report=report, strings=strings)
+    with stats.timer('dump'):
+        if new_code == code:
+            if report:
+                del report[:]
+            return '' if diff else False
+    if verify:
+        with stats.timer('verify'):
+            verify_update(path, code, new_code, table, verify)
+    with stats.timer('dump'):
+        if diff:
+            return unified_diff(path, code, new_code)
+        new_source = new_code.encode(encoding)
+    with stats.timer('write'):
+        write_atomic(path, new_source)
+    if cache:
+        if isinstance(ast, list):
+            ast = find_import_nodes(new_code)
+        cache.put(path, new_source, import_table(path, ast))
+    return True
+
+
+def update_imports_parsed(path, moves, parsed, stats=None, report=None, strings=None):
+    """Update imports in parsed, the ParsedFile of the file at path, and
+    return its new code, which is parsed.code if nothing changed. It doesn't
+    touch the file itself. A RedBaron tree in parsed is updated in place. See
+    update_imports_file() for the rest."""
+    if stats is None:
+        stats = Stats()
+    code, encoding, ast, import_only = parsed
+    with stats.timer('transform'):
+        if isinstance(ast, list):
+            new_code, edits = update_imports_code(path, code, moves, ast, stats=stats, report=report, import_only=import_only)
+        else:
+            edits = update_imports_ast(path, ast, moves, stats=stats, report=report)
+    stats.edits += edits
+    if not edits and strings is None:
+        return code
+    with stats.timer('dump'):
+        if not isinstance(ast, list):
+            new_code = ast.dumps() if edits else code
+    if strings is not None:
+        with stats.timer('transform'):
+            new_code, found = update_strings(path, new_code, strings, report)
+        stats.edits += found
+        if report:
+            report.sort(key=lambda record: record['line'])
+    return new_code
+
+
+class VerificationError(Exception):
+    """Raised when updated code fails verify_update()."""
+
+
+def verify_update(path, old_code, new_code, old_table, resolver):
+    """Check new_code, the updated code of the file at path, before it's
+    written: that it compiles, unless old_code didn't either (eg it's Python
+    2), and that each import in it that's new, compared with old_table (the
+    import_table() of old_code), is of something resolver (a ModuleResolver)
+    finds in the project. An import of a top level name that isn't in the
+    project at all counts as found if it's installed, eg in the stdlib. A
+    name imported from a module is taken to be defined in it, but one
+    imported from a package has to be a submodule of it or bound in its
+    __init__.py. Raises VerificationError if a check fails."""
+    try:
+        tree = compile(new_code, path, 'exec', pyast.PyCF_ONLY_AST)
+        compile(tree, path, 'exec')
+    except (SyntaxError, ValueError) as e:
+        try:
+            compile(old_code, path, 'exec')
+        except (SyntaxError, ValueError):
+            return
+        raise VerificationError("the updated code doesn't compile: %s" % e)
+    old = set()
+    for kind, module, names in old_table:
+        old.add(module)
+        old.update(module + '.' + name for name in names)
+    nodes = [node for node in pyast.walk(tree) if isinstance(node, (pyast.Import, pyast.ImportFrom))]
+    for kind, module, names, node in iter_imports(path, nodes):
+        if module not in old and not _resolves(resolver, module):
+            raise VerificationError("line %d imports %s, which isn't in the project" % (node.lineno, module))
+        if kind == 'from':
+            found, found_module = resolver.find(module)
+            for name in names:
+                full = module + '.' + name
+                if name == '*' or full in old or _resolves(resolver, full):
+                    continue
+                if found == module and (found_module.kind == 'module' or resolver.binds(found_module.paths[0], name)):
+                    continue
+                raise VerificationError("line %d imports %s, which isn't in the project" % (node.lineno, full))
+
+
+def _resolves(resolver, name):
+    """Return whether name is a module or package in the project, or its top
+    level isn't in the project but is installed."""
+    if resolver.resolve(name):
+        return True
+    top = name.split('.')[0]
+    if resolver.resolve(top) or not top:
+        return False
+    try:
+        return importlib.util.find_spec(top) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def update_strings_file(path, strings, source=None, stats=None, diff=False, report=None):
+    """Update the old paths that strings (a PathScanner) finds anywhere in the
+    file at path, which isn't Python, eg a config file like setup.cfg with
+    entry points in it. It's read as UTF-8. Otherwise it's like
+    update_imports_file()."""
+    if stats is None:
+        stats = Stats()
+    if source is None:
+        with stats.timer('read'):
+            with open(path, 'rb') as f:
+                source = f.read()
+    code = source.decode('utf-8')
+    with stats.timer('transform'):
+        new_code, found = update_strings(path, code, strings, report, python=False)
+    stats.edits += found
+    if new_code == code:
+        return '' if diff else False
+    if diff:
+        return unified_diff(path, code, new_code)
+    with stats.timer('write'):
+        write_atomic(path, new_code.encode('utf-8'))
+    return True
+
+
+ParsedFile = namedtuple('ParsedFile', ['code', 'encoding', 'ast', 'import_only'], defaults=[False])
+
+
+def parse_file(path, source, engine='fast', import_only=False):
+    """Decode source, the raw contents of the file at path, and parse it for
+    engine (see update_imports_file()), or if import_only is true, parse only
+    its import statements with scan_import_nodes(), so memory use doesn't
+    grow with the rest of the file, which then isn't parsed at all, even to
+    update references. Returns a ParsedFile of the code, its encoding, its
+    RedBaron tree or list of stdlib import nodes, and import_only. source can
+    also be code that's already decoded (a str), in which case the encoding
+    is None."""
+    if isinstance(source, str):
+        code, encoding = source, None
+    else:
+        encoding = tokenize.detect_encoding(io.BytesIO(source).readline)[0]
+        code = source.decode(encoding)
+    if engine == 'fast' or import_only:
+        try:
+            return ParsedFile(code, encoding, scan_import_nodes(code) if import_only else find_import_nodes(code), import_only)
+        except SyntaxError:
+            if not have_redbaron():
+                raise
+            log.debug("Falling back to RedBaron for %s", path, exc_info=True)
+    if not have_redbaron():
+        raise RuntimeError("the redbaron engine needs redbaron, which isn't installed")
+    return ParsedFile(code, encoding, RedBaron(code))
+
+
+def redbaron():
+    """Return the redbaron module, importing it the first time, or None if it
+    isn't installed. It's only imported once a file needs it, since importing
+    it builds its parser's grammar, which takes longer than a small run takes
+    to do everything else."""
+    global _redbaron
+    if _redbaron is None:
+        try:
+            import redbaron as module
+        except ImportError: # only needed by the redbaron engine
+            module = False
+        _redbaron = module
+    return _redbaron or None
+
+
+def have_redbaron():
+    """Return whether redbaron is installed, without importing it."""
+    if _redbaron is None:
+        return importlib.util.find_spec('redbaron') is not None
+    return bool(_redbaron)
+
+
+def RedBaron(code):
+    """Parse code with RedBaron, importing it if need be (see redbaron())."""
+    return redbaron().RedBaron(code)
+
+
+def unified_diff(path, old, new):
+    """Return a unified diff from old to new code of the file at path, in the
+    form git apply and patch -p1 take."""
+    path = os.path.normpath(path).replace(os.sep, '/')
+    lines = difflib.unified_diff(old.splitlines(True), new.splitlines(True), 'a/' + path, 'b/' + path)
+    return ''.join(line if line.endswith('\n') else line + '\n\\ No newline at end of file\n' for line in lines)
+
+
+def write_atomic(path, data):
+    """Replace the file at path with data (bytes) by writing a temp file next
+    to it and renaming that over it, so an interrupted write never leaves a
+    truncated file behind. The file's permissions are kept if it exists, and
+    a symlink is written through to the file it points to."""
+    path = os.path.realpath(path)
+    dirname, basename = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.tmp', dir=dirname or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def import_table(path, ast):
+    """Return a summary of the imports in ast, the RedBaron tree of the file at
+    path or its list of stdlib import nodes from find_import_nodes(), that's
+    enough to tell whether any move would update them. It's a list of [kind,
+    module, names] lists, with kind 'import' or 'from', module made absolute
+    with abs_mod_path() and names the targets of from imports."""
+    return [[kind, module, names] for kind, module, names, node in iter_imports(path, ast)]
+
+
+def iter_imports(path, ast):
+    """Yield (kind, module, names, node) for each import in ast, the RedBaron
+    tree of the file at path or its list of stdlib import nodes, where kind is
+    'import' or 'from', module is absolute and names are the targets of from
+    imports. Plain imports of several modules yield one tuple per module."""
+    if isinstance(ast, list):
+        for node in ast:
+            if isinstance(node, pyast.Import):
+                for alias in node.names:
+                    yield 'import', abs_mod_path(path, alias.name), [], node
+            else:
+                yield 'from', abs_mod_path(path, '.' * node.level + (node.module or '')), [alias.name for alias in node.names], node
+        return
+    for stmt in ast.find_all('ImportNode'):
+        for imp in stmt.value:
+            yield 'import', abs_mod_path(path, imp.value.dumps()), [], stmt
+    for fin in ast.find_all('FromImportNode'):
+        yield 'from', abs_mod_path(path, fin.value.dumps()), [tgt.value for tgt in _fin_targets(fin)], fin
+
+
+def _fin_targets(fin):
+    """Return the targets of a RedBaron FromImportNode, without any parens."""
+    return [tgt for tgt in fin.targets if tgt.type in ('name_as_name', 'star')]
+
+
+def _set_fin_targets(fin, targets, parens):
+    """Replace the targets of a RedBaron FromImportNode with targets, in
+    parens if parens is true. The whole list is rewritten rather than
+    appended to or removed from since RedBaron leaves stray commas in parens
+    and moves a following '; ...' or comment onto a line of its own."""
+    targets = ', '.join(tgt.dumps() for tgt in targets)
+    fin.targets = '(%s)' % targets if parens else targets
+
+
+def _remove_statement(node):
+    """Remove node, a RedBaron statement, and the newline after it. This goes
+    around its parent's remove(), which moves a '; ...' or comment ending the
+    line before it onto a line of its own."""
+    proxy = node.parent if isinstance(node.parent, redbaron().base_nodes.ProxyList) else getattr(node.parent, 'value', None)
+    if not isinstance(proxy, redbaron().base_nodes.LineProxyList) or node not in proxy.node_list:
+        node.parent.remove(node)
+        return
+    nodes = proxy.node_list
+    i = nodes.index(node)
+    end = i + 2 if i + 1 < len(nodes) and nodes[i + 1].type == 'endl' else i + 1
+    del nodes[i:end]
+    proxy.data = proxy._build_inner_list(nodes)
+
+
+def node_line(node):
+    """Return the line number of node, a stdlib ast or RedBaron node."""
+    if isinstance(node, pyast.AST):
+        return node.lineno
+    return node.absolute_bounding_box.top_left.line
+
+
+def import_table_matches(table, moves):
+    """Return whether any move (a MoveIndex) would update an import in table,
+    as returned by import_table()."""
+    for kind, module, names in table:
+        if moves.find(module):
+            return True
+        for name in names:
+            move = moves.find(module + '.' + name)
+            if move and move[0].full == module + '.' + name:
+                return True
+    return False
+
+
+class ImportCache(object):
+    """On-disk cache of files' import tables (see import_table()), keyed by
+    path and a hash of the file's contents so edits invalidate entries.
+
+    Entries live in a subdirectory per CACHE_VERSION, and the others are
+    removed by prune(), so a tool upgrade that changes how tables are built
+    starts from an empty cache. Since entries are written atomically it's safe
+    to share between worker processes. Reading an entry marks it as recently
+    used, and prune() evicts the least recently used ones to keep the total
+    size under max_bytes; call it once a run is done."""
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.root = directory
+        self.directory = os.path.join(directory, 'v%d' % CACHE_VERSION)
+        self.max_bytes = max_bytes
+
+    def _entry(self, path, source):
+        key = hashlib.sha1(path.encode('utf-8') + b'\0' + source).hexdigest()
+        return os.path.join(self.directory, key[:2], key[2:] + '.json')
+
+    def get(self, path, source):
+        """Return the cached import table for the file at path with raw
+        contents source, or None if there isn't one."""
+        entry = self._entry(path, source)
+        try:
+            with open(entry, 'r') as f:
+                table = json.load(f)
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return table
+
+    def put(self, path, source, table):
+        entry = self._entry(path, source)
+        dirname = os.path.dirname(entry)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        write_atomic(entry, json.dumps(table, separators=(',', ':')).encode('utf-8'))
+
+    def prune(self):
+        """Remove entries from other cache versions and evict the least
+        recently used entries until the cache fits in max_bytes."""
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                if path != self.directory and re.match(r'v\d+$', name) and os.path.isdir(path):
+                    log.debug("Removing stale cache %s", path)
+                    shutil.rmtree(path, ignore_errors=True)
+        entries = []
+        total = 0
+        for dirpath, dirnames, fnames in os.walk(self.directory):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def file_digest(source):
+    """Return a hash of source, the raw contents of a file."""
+    return hashlib.sha1(source).hexdigest()
+
+
+class Journal(object):
+    """A record of a run's progress, so a run that's stopped part way can be
+    resumed without redoing the files it already did. It's a file of JSON
+    lines: one with the run's settings (eg its moves), then one with the path
+    and file_digest() of the contents of each file once it's done, written as
+    each is done so it's up to date whenever the run stops.
+
+    If resume is true and the journal was written by a run with the same
+    settings, files it has as done whose contents still have the same digest
+    are skipped, and the rest are added to it. Otherwise, eg if the moves
+    changed, it's started over. A partly written last line from a run that
+    was killed is ignored."""
+
+    def __init__(self, path, settings, resume=False):
+        self.path = path
+        self.resumed = 0
+        header = {'version': CACHE_VERSION, 'settings': settings}
+        lines = None
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                lines = f.read().split('\n')
+            if self._header(lines[0]) != header:
+                log.warning("The journal %s is for different moves or settings, so starting over", path)
+                lines = None
+        self.done = {} # path -> digest
+        if lines is None:
+            self.file = open(path, 'w')
+            self._write(header)
+            return
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self.done[entry['path']] = entry['digest']
+        self.file = open(path, 'a')
+        if lines[-1]:
+            self.file.write('\n') # after a partly written line
+
+    @staticmethod
+    def _header(line):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def _write(self, data):
+        self.file.write(json.dumps(data, sort_keys=True) + '\n')
+        self.file.flush()
+
+    def unfinished(self, paths):
+        """Yield those of paths that aren't done, or that have changed since."""
+        for path in paths:
+            digest = self.done.get(path)
+            if digest:
+                try:
+                    with open(path, 'rb') as f:
+                        if file_digest(f.read()) == digest:
+                            self.resumed += 1
+                            continue
+                except (IOError, OSError):
+                    pass
+            yield path
+
+    def record(self, path, digest):
+        """Record that the file at path is done, and now has digest."""
+        self.done[path] = digest
+        self._write({'path': path, 'digest': digest})
+
+    def close(self):
+        self.file.close()
+
+
+class ImportGraph(object):
+    """Reverse import index of a project: for each module or symbol imported
+    (made absolute with abs_mod_path()), which files import it on which lines.
+
+    update() builds or refreshes it in one pass over the files, only reading
+    ones whose size or mtime changed since they were indexed, and save() and
+    load() store it as JSON so it can be reused across runs. Files that can't
+    be parsed are kept with imports of None, and always count as importers
+    since their imports aren't known."""
+
+    def __init__(self):
+        self.files = {} # path -> {'mtime': ns, 'size': bytes, 'imports': [[name, line], ...] or None}
+        self._importers = None # name -> {path: [line, ...]}
+        self._names = None # sorted names in _importers, for prefix queries
+
+    @classmethod
+    def load(cls, path):
+        """Load a graph saved to path, or return an empty one if there isn't
+        one there or it's from a different version."""
+        graph = cls()
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return graph
+        if data.get('version') == CACHE_VERSION:
+            graph.files = data['files']
+        return graph
+
+    def save(self, path):
+        data = json.dumps({'version': CACHE_VERSION, 'files': self.files}, separators=(',', ':'), sort_keys=True)
+        write_atomic(path, data.encode('utf-8'))
+
+    def update(self, paths, complete=True):
+        """Index paths whose size or mtime changed since they were last indexed.
+        If complete is true, paths are all the project's files, so indexed
+        files that aren't in them are dropped. Returns the paths reindexed."""
+        seen = set()
+        changed = []
+        for path in paths:
+            seen.add(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = self.files.get(path)
+            if entry and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                continue
+            with open(path, 'rb') as f:
+                source = f.read()
+            self.files[path] = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'imports': file_imports(path, source)}
+            changed.append(path)
+        if complete:
+            for path in set(self.files) - seen:
+                del self.files[path]
+                changed.append(path)
+        if changed:
+            self._importers = self._names = None
+        return changed
+
+    def _index(self):
+        if self._importers is None:
+            self._importers = {}
+            for path, entry in self.files.items():
+                for name, line in entry['imports'] or []:
+                    self._importers.setdefault(name, {}).setdefault(path, []).append(line)
+            self._names = sorted(self._importers)
+        return self._importers
+
+    def importers(self, name):
+        """Return {path: [line, ...]} of the files that import name or anything
+        under it, eg for pkg.mod, both 'from pkg.mod import func' and 'from pkg
+        import mod'."""
+        importers = self._index()
+        found = {}
+        names = [name] if name in importers else []
+        start = bisect.bisect_left(self._names, name + '.')
+        end = bisect.bisect_left(self._names, name + '/') # '/' sorts right after '.'
+        names.extend(self._names[start:end])
+        for n in names:
+            for path, lines in importers[n].items():
+                found.setdefault(path, set()).update(lines)
+        return {path: sorted(lines) for path, lines in found.items()}
+
+    def unparsed(self):
+        """Return the paths of files whose imports aren't known."""
+        return [path for path, entry in self.files.items() if entry['imports'] is None]
+
+    def files_for(self, moves):
+        """Return the sorted paths of the files that might need updating for
+        moves: those importing something under an old path, plus ones whose
+        imports aren't known."""
+        paths = set(self.unparsed())
+        for old, new in moves:
+            paths.update(self.importers(old.full))
+        return sorted(paths)
+
+
+def file_imports(path, source):
+    """Return [[name, line], ...] of everything imported by the file at path
+    with raw contents source, or None if it can't be parsed. For a from
+    import, both the module and module.name are included."""
+    try:
+        ast = parse_file(path, source).ast
+    except Exception:
+        log.debug("Can't parse %s", path, exc_info=True)
+        return None
+    imports = []
+    for kind, module, names, node in iter_imports(path, ast):
+        line = node_line(node)
+        imports.append([module, line])
+        imports.extend([module + '.' + name, line] for name in names if name != '*')
+    return imports
+
+
+Module = namedtuple('Module', ['kind', 'paths', 'dirs'])
+
+
+def default_roots(paths):
+    """Return the dirs to find top level modules in for a project at paths:
+    each dir in paths (or the dir of each file), followed by its src dir if it
+    has one that isn't a package itself. paths can also be a single path."""
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    roots = []
+    for path in paths:
+        root = path if os.path.isdir(path) else os.path.dirname(path) or '.'
+        src = os.path.join(root, 'src')
+        dirs = [root]
+        if os.path.isdir(src) and not os.path.isfile(os.path.join(src, '__init__.py')):
+            dirs.append(src)
+        roots.extend(dirname for dirname in dirs if dirname not in roots)
+    return roots
+
+
+class ModuleResolver(object):
+    """Works out what dotted names are in a project statically, by looking for
+    their files under roots the way the import system would, rather than
+    importing anything. Finds modules, regular packages, and namespace
+    packages (dirs without an __init__.py, which can be split across roots).
+    Lookups are memoized, so make a new one if the project's files change."""
+
+    def __init__(self, roots):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self._modules = {} # name -> Module or None
+        self._from_imports = {} # path -> {module: set of names}
+        self._bound = {} # path -> set of names or None
+
+    def resolve(self, name):
+        """Return a Module for the dotted name, with kind 'module', 'package' or
+        'namespace', the files it's in (more than one if the first shadows
+        others) and the dirs its submodules are in, or None if it isn't a
+        module or package."""
+        if name not in self._modules:
+            parent, _, last = name.rpartition('.')
+            if parent:
+                module = self.resolve(parent)
+                dirs = module.dirs if module else []
+            else:
+                dirs = self.roots
+            kind = None
+            paths = []
+            subdirs = []
+            namespace = []
+            for dirname in dirs:
+                base = os.path.join(dirname, last)
+                found = False
+                if os.path.isfile(os.path.join(base, '__init__.py')):
+                    kind = kind or 'package'
+                    paths.append(os.path.join(base, '__init__.py'))
+                    subdirs = subdirs or [base]
+                    found = True
+                if os.path.isfile(base + '.py'):
+                    kind = kind or 'module'
+                    paths.append(base + '.py')
+                    found = True
+                if not found and os.path.isdir(base):
+                    namespace.append(base)
+            if kind:
+                self._modules[name] = Module(kind, paths, subdirs)
+            elif namespace:
+                self._modules[name] = Module('namespace', [], namespace)
+            else:
+                self._modules[name] = None
+        return self._modules[name]
+
+    def find(self, name):
+        """Return the longest of name and its parents that's a module or
+        package with a file, and its Module, or (None, None) if there isn't
+        one. If it's a parent, the rest of name is a symbol in it."""
+        while name:
+            module = self.resolve(name)
+            if module and module.paths:
+                return name, module
+            name = name.rpartition('.')[0]
+        return None, None
+
+    def describe(self, name):
+        """Return what name is in the project, eg 'module pkg/mod.py'."""
+        module = self.resolve(name)
+        if module and module.kind == 'namespace':
+            return "namespace package %s" % ', '.join(os.path.relpath(dirname) for dirname in module.dirs)
+        found, module = self.find(name)
+        if not found:
+            return "not in the project"
+        if found != name:
+            return "in %s %s" % (module.kind, os.path.relpath(module.paths[0]))
+        if module.kind == 'package':
+            return "package %s" % os.path.relpath(module.dirs[0])
+        return "module %s" % os.path.relpath(module.paths[0])
+
+    def module_name(self, path):
+        """Return the dotted name of the module in the file at path, found
+        from the deepest root it's under, or None if it isn't under one."""
+        path = os.path.abspath(path)
+        for root in sorted(self.roots, key=len, reverse=True):
+            rel = os.path.relpath(path, root)
+            if rel.startswith(os.pardir + os.sep) or not rel.endswith('.py'):
+                continue
+            parts = rel[:-3].split(os.sep)
+            if parts[-1] == '__init__':
+                parts.pop()
+            return '.'.join(parts) or None
+        return None
+
+    def reexports(self, moves):
+        """Return (name, move) pairs for each of moves whose old path is
+        re-exported by a package or module above it, where name is where it's
+        re-exported to, eg pkg.func if pkg/__init__.py has 'from .mod import
+        func' and pkg.mod.func is moved. The parents' files are parsed to find
+        these, rather than imported."""
+        found = []
+        for old, new in moves:
+            parts = old.full.split('.')
+            names = [old.full]
+            for i in range(len(parts) - 2, 0, -1):
+                parent = '.'.join(parts[:i])
+                module = self.resolve(parent)
+                if not module or not module.paths:
+                    continue
+                imports = self._imports(module.paths[0])
+                for name in list(names):
+                    names_imported = imports.get(name.rpartition('.')[0], ())
+                    if old.last in names_imported or '*' in names_imported:
+                        names.append(parent + '.' + old.last)
+                        break
+            found.extend((name, (old, new)) for name in names[1:])
+        return found
+
+    def binds(self, path, name):
+        """Return whether the module in the file at path binds name at its top
+        level, eg with a def, class, assignment or import, or might, because
+        it has a star import or a module __getattr__ or can't be parsed with
+        the stdlib ast module."""
+        if path not in self._bound:
+            self._parse(path)
+        bound = self._bound[path]
+        return bound is None or bool({name, '*', '__getattr__'} & bound)
+
+    def _imports(self, path):
+        if path not in self._from_imports:
+            self._parse(path)
+        return self._from_imports[path]
+
+    def _parse(self, path):
+        imports = {}
+        bound = None
+        try:
+            with open(path, 'rb') as f:
+                source = f.read()
+            # Relative imports are resolved from the module's name, not
+            # its path, since it may be under a root like src/.
+            name = self.module_name(path)
+            if name is None:
+                rel = os.path.relpath(path)
+            elif os.path.basename(path) == '__init__.py':
+                rel = name.replace('.', '/') + '/__init__.py'
+            else:
+                rel = name.replace('.', '/') + '.py'
+            try:
+                tree = pyast.parse(source)
+            except SyntaxError:
+                nodes = parse_file(rel, source).ast
+            else:
+                nodes = [node for node in pyast.walk(tree) if isinstance(node, (pyast.Import, pyast.ImportFrom))]
+                bound = _bound_names(tree)
+            for kind, module, names, node in iter_imports(rel, nodes):
+                if kind == 'from':
+                    imports.setdefault(module, set()).update(names)
+        except Exception:
+            log.debug("Can't parse %s", path, exc_info=True)
+        self._from_imports[path] = imports
+        self._bound[path] = bound
+
+
+def _bound_names(tree):
+    """Return the names bound in tree, a stdlib ast module, outside its
+    functions and classes, with '*' for a star import."""
+    names = set()
+    nodes = list(tree.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (pyast.FunctionDef, pyast.AsyncFunctionDef, pyast.ClassDef)):
+            names.add(node.name)
+            continue
+        if isinstance(node, pyast.Import):
+            names.update(alias.asname or alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, pyast.ImportFrom):
+            names.update(alias.asname or alias.name for alias in node.names)
+        elif isinstance(node, pyast.Name) and isinstance(node.ctx, pyast.Store):
+            names.add(node.id)
+        elif isinstance(node, pyast.ExceptHandler) and node.name:
+            names.add(node.name)
+        nodes.extend(pyast.iter_child_nodes(node))
+    return names
+
+
+def check_moves(moves, resolver):
+    """Check moves (from parse_moves()) against the project's modules using
+    resolver (a ModuleResolver), logging a warning for each move where neither
+    its old path nor its new one (if it's been moved already) is in the
+    project, or where either is ambiguous because it's in more than one file.
+    Returns the number of warnings."""
+    warnings = 0
+    for old, new in moves:
+        old_name, old_module = resolver.find(old.full)
+        new_name, new_module = resolver.find(new.full)
+        if not old_name and not new_name and not resolver.resolve(old.full) and not resolver.resolve(new.full):
+            log.warning("Neither %s nor %s is in the project's files", old.full, new.full)
+            warnings += 1
+        for name, module in [(old_name, old_module), (new_name, new_module)]:
+            if module and len(module.paths) > 1:
+                log.warning("%s is ambiguous, it's in each of %s", name, ', '.join(os.path.relpath(path) for path in module.paths))
+                warnings += 1
+    return warnings
+
+
+def print_plan(moves, resolver, graph, out):
+    """Write the order moves will be made in, what each moves, and the files
+    and lines each will update according to graph (an ImportGraph) to out."""
+    for old, new in moves:
+        importers = graph.importers(old.full)
+        out.write("%s -> %s: %s, imported by %d files\n" % (old.full, new.full, resolver.describe(old.full), len(importers)))
+        for path, lines in sorted(importers.items()):
+            out.write("    %s:%s\n" % (path, ','.join(str(line) for line in lines)))
+    unparsed = graph.unparsed()
+    if unparsed:
+        out.write("%d files couldn't be parsed, so may need updating too:\n" % len(unparsed))
+        for path in sorted(unparsed):
+            out.write("    %s\n" % path)
+
+
+class ImportServer(object):
+    """Keeps a project's reverse import index (an ImportGraph) and its parsed
+    files in memory between moves, so a move only reads and parses what
+    changed since the last one. Files changed on disk are noticed by polling
+    their mtimes, and at most max_trees parsed files are kept, evicting the
+    least recently used ones. roots are as for ModuleResolver, and default to
+    default_roots(paths)."""
+
+    def __init__(self, paths, hidden_dirs=False, exclude=None, git=False, engine='fast', max_trees=1000, roots=None):
+        self.paths = paths
+        self.roots = roots or default_roots(paths)
+        self.walk_args = dict(hidden_dirs=hidden_dirs, exclude=exclude, git=git)
+        self.engine = engine
+        self.max_trees = max_trees
+        self.graph = ImportGraph()
+        self.trees = OrderedDict() # path -> ((mtime, size), ParsedFile), least recently used first
+
+    def refresh(self):
+        """Reindex files changed since the last refresh and forget their parsed
+        trees. Returns the paths that changed."""
+        changed = self.graph.update(recurse(self.paths, **self.walk_args))
+        for path in changed:
+            self.trees.pop(path, None)
+        log.info("Reindexed %d changed files of %d", len(changed), len(self.graph.files))
+        return changed
+
+    def _parsed(self, path):
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        entry = self.trees.get(path)
+        if entry and entry[0] == key:
+            self.trees.move_to_end(path)
+            return entry[1]
+        with open(path, 'rb') as f:
+            parsed = parse_file(path, f.read(), self.engine)
+        self._keep(path, key, parsed)
+        return parsed
+
+    def _keep(self, path, key, parsed):
+        self.trees[path] = (key, parsed)
+        self.trees.move_to_end(path)
+        while len(self.trees) > self.max_trees:
+            self.trees.popitem(last=False)
+
+    def move(self, moves):
+        """Update imports for moves (as returned by parse_moves()) in the files
+        that import something moved. Returns (modified paths, [(path, error
+        message), ...])."""
+        self.refresh()
+        moves = MoveIndex(moves, reexports=ModuleResolver(self.roots).reexports(moves))
+        modified = []
+        errors = []
+        for path in self.graph.files_for(moves):
+            try:
+                parsed = self._parsed(path)
+                if not update_imports_file(path, moves, engine=self.engine, parsed=parsed):
+                    continue
+            except Exception as e:
+                log.error("Failed to update %s: %s", path, e, exc_info=log.isEnabledFor(logging.DEBUG))
+                errors.append((path, str(e)))
+                self.trees.pop(path, None)
+                continue
+            modified.append(path)
+            if isinstance(parsed.ast, list):
+                # stdlib nodes point into the old code, so it has to be parsed again
+                self.trees.pop(path, None)
+            else:
+                # a RedBaron tree was updated in place and still matches the file
+                st = os.stat(path)
+                self._keep(path, (st.st_mtime_ns, st.st_size), parsed._replace(code=parsed.ast.dumps()))
+        self.graph.update(modified, complete=False)
+        return modified, errors
+
+    def handle(self, request):
+        """Handle a request, a dict with "moves" (a list of [old, new] pairs or
+        an {old: new} object) and optionally an "id" echoed in the response.
+        Returns the response dict."""
+        start = time.time()
+        response = {'id': request.get('id')}
+        moves = request.get('moves')
+        if isinstance(moves, dict):
+            moves = list(moves.items())
+        try:
+            if not moves or not all(isinstance(m, (list, tuple)) and len(m) == 2 for m in moves):
+                raise ValueError("expected \"moves\" to be a list of [old, new] pairs but got %r" % (moves,))
+            moves = parse_moves(moves)
+        except (ValueError, AttributeError) as e:
+            response['error'] = str(e)
+            return response
+        try:
+            modified, errors = self.move(moves)
+        except Exception as e:
+            log.error("Failed to make moves: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+            response['error'] = "%s: %s" % (type(e).__name__, e)
+            return response
+        response.update({
+            'modified': modified,
+            'errors': [{'path': path, 'error': error} for path, error in errors],
+            'seconds': round(time.time() - start, 3),
+        })
+        return response
+
+    def serve(self, infile, outfile):
+        """Handle requests read from infile, one JSON object per line, writing a
+        JSON response line for each to outfile, until infile ends."""
+        for line in infile:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("expected a JSON object")
+            except ValueError as e:
+                response = {'id': None, 'error': "bad request: %s" % e}
+            else:
+                response = self.handle(request)
+            data = json.dumps(response) + '\n'
+            outfile.write(data if isinstance(outfile, io.TextIOBase) else data.encode('utf-8'))
+            outfile.flush()
+
+    def serve_socket(self, path):
+        """Serve requests from connections to a unix socket at path, one
+        connection at a time, until interrupted. A socket left at path by an
+        earlier run is replaced, but ValueError is raised if anything else is
+        there."""
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.serve(self.rfile, self.wfile)
+
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise ValueError("%s already exists and isn't a socket" % path)
+            os.unlink(path)
+        with socketserver.UnixStreamServer(path, Handler) as sock:
+            log.info("Listening on %s", path)
+            try:
+                sock.serve_forever()
+            finally:
+                os.unlink(path)
+
+
+SourceResult = namedtuple('SourceResult', ['path', 'source', 'changed', 'edits', 'warnings', 'error'])
+
+
+class ImportUpdater(object):
+    """Updates imports in sources held in memory, eg by an editor or a
+    service, rather than in files, so nothing is read or written. The moves
+    are parsed and indexed once, when it's made, and nothing about it changes
+    after that, so one can be kept for as many calls as there are and called
+    from several threads at once. moves are [old, new] pairs as for
+    parse_moves() (which raises ValueError for bad ones). engine is as for
+    update_imports_file(), and strings, if given, is 'update' or 'report' to
+    update or report old paths in strings (see update_strings()). If roots is
+    given, it's used to warn about imports of moved things through modules
+    that re-export them (see ModuleResolver)."""
+
+    def __init__(self, moves, engine='fast', strings=None, roots=None):
+        moves = parse_moves(moves)
+        self.moves = MoveIndex(moves, reexports=ModuleResolver(roots).reexports(moves) if roots else ())
+        self.heads = move_heads(self.moves)
+        self.engine = engine
+        self.strings = PathScanner(self.moves, rewrite=strings == 'update') if strings else None
+
+    def update(self, sources):
+        """Yield a SourceResult for each of sources, a mapping of path to
+        source or an iterable of (path, source) pairs, in order. See
+        update_source()."""
+        if hasattr(sources, 'items'):
+            sources = sources.items()
+        for path, source in sources:
+            yield self.update_source(path, source)
+
+    def update_source(self, path, source):
+        """Update imports in source, the code (a str) or raw contents (bytes)
+        of the file at path, and return a SourceResult of the path, the new
+        source of the same type (the same object if it's unchanged), whether
+        it changed, a record of each edit (see update_imports_file()), the
+        messages of any warnings, and an error message if it couldn't be
+        updated, eg because it couldn't be parsed. path is only used to
+        resolve relative imports and in messages. If it isn't a .py file,
+        only strings are updated, anywhere in source."""
+        edits = []
+        with _captured_warnings() as warnings:
+            try:
+                raw = source if isinstance(source, bytes) else source.encode('utf-8', 'surrogateescape')
+                has_strings = self.strings is not None and self.strings.search(raw)
+                if not path.endswith('.py') or not may_need_update(path, raw, self.heads):
+                    if not has_strings:
+                        return SourceResult(path, source, False, [], warnings, None)
+                if not path.endswith('.py'):
+                    code = source if isinstance(source, str) else source.decode('utf-8')
+                    parsed = ParsedFile(code, None if isinstance(source, str) else 'utf-8', None)
+                    new_code = update_strings(path, code, self.strings, edits, python=False)[0]
+                else:
+                    parsed = parse_file(path, source, self.engine)
+                    new_code = update_imports_parsed(path, self.moves, parsed, report=edits, strings=self.strings)
+            except Exception as e:
+                log.debug("Error updating %s", path, exc_info=True)
+                return SourceResult(path, source, False, edits, warnings, "%s: %s" % (type(e).__name__, e))
+        if new_code == parsed.code:
+            return SourceResult(path, source, False, [], warnings, None)
+        return SourceResult(path, new_code if parsed.encoding is None else new_code.encode(parsed.encoding), True, edits, warnings, None)
+
+
+def update_imports_ast(path, ast, moves, stats=None, report=None):
+    """Update imports in ast, the RedBaron tree of the file at path, in place.
+    Returns the number of imports updated. If stats (a Stats) is given, the
+    number of imports examined is added to it. If report (a list) is given,
+    a record of each statement or reference updated is appended to it (see
+    update_imports_file())."""
+    log.debug("Processing file %s", path)
+    if not isinstance(moves, MoveIndex):
+        moves = MoveIndex(moves)
+    edits = 0
+    bindings = Bindings()
+    reported = len(report) if report is not None else 0
 
     for stmt in ast.find_all('ImportNode'):
         log.debug("  Processing statement: %s", stmt)
+        if stats:
+            stats.imports += 1
+        old_stmt = stmt.dumps() if report is not None else None
+        applied = []
 
         for imp in stmt.value:
             log.debug("    Processing subimport %s", imp)
 
             absfrm = abs_mod_path(path, imp.value.dumps())
-            log.debug("      Absolute path %s", absfrm)
+            plan = plan_import(moves, absfrm, imp.target)
+            bindings.add(imp.value.dumps(), imp.target, plan)
+            if not plan:
+                continue
+            if plan.target:
+                imp.target = plan.target
+            imp.value = plan.name
+            edits += 1
+            applied.append(plan.move)
+            log.debug("        Updated subimport to %r", imp)
+        if applied and report is not None:
+            report.append(_edit_record(node_line(stmt), old_stmt, stmt.dumps(), applied))
 
-            # if imp.value startswith any warning paths
-            #     warn
+    # References are updated before from imports are split so their lines
+    # haven't moved yet.
+    if bindings.rebound:
+        atoms = []
+        for node in ast.find_all(['atomtrailers', 'assignment', 'def', 'class', 'def_argument', 'list_argument', 'dict_argument', 'for',
+                                  'comprehension_loop', 'with_context_item', 'except']):
+            if node.type == 'atomtrailers':
+                atoms.append(node)
+            elif node.type in ('def', 'class'):
+                bindings.shadowed.add(node.name)
+            elif node.type in ('list_argument', 'dict_argument'):
+                bindings.shadowed.update(_redbaron_bound_names(node.value))
+            else:
+                attr = {'assignment': 'target', 'def_argument': 'target', 'for': 'iterator', 'comprehension_loop': 'iterator',
+                        'with_context_item': 'as_', 'except': 'target'}[node.type]
+                bindings.shadowed.update(_redbaron_bound_names(getattr(node, attr)))
+        for atom in atoms:
+            names = []
+            for value in atom.value:
+                if value.type != 'name':
+                    break
+                names.append(value.value)
+            plan = bindings.plan(moves, '.'.join(names), path, node_line(atom))
+            if not plan:
+                continue
+            move, count = plan
+            if report is not None:
+                report.append(_edit_record(node_line(atom), '.'.join(names[:count]), move[1].full, [move]))
+            new_names = move[1].full.split('.')
+            for i, name in enumerate(new_names[:count]):
+                atom.value[i].value = name
+            for i, name in enumerate(new_names[count:], count):
+                atom.value.insert(i, name)
+            for _ in range(count - len(new_names)):
+                del atom.value[len(new_names)]
+            edits += 1
+            log.debug("    Updated reference to %s", atom)
 
-            for old, new in moves:
-                log.debug("      Processing move %s -> %s for 'import' updates", old.full, new.full)
-                # if tail was changed and stmt.value == oldpath and as is None
-                if absfrm == old.full and not imp.target:
-                    if len(imp.value) == 1:
-                        imp.target = imp.value.dumps()
-                    else:
-                        log.debug("Warning: updating 'import %s' to 'import %s'; you'll nned to any references to %s", old.full, new.full, old.full)
-                if absfrm.startswith(old.full):
-                    imp.value = new.full + absfrm[len(old.full):]
-                    log.debug("        Updated subimport to %r", imp)
+    fins = ast.find_all('FromImportNode')
+    plans = plan_from_imports(path, moves, [
+        (abs_mod_path(path, fin.value.dumps()), [(tgt.value, getattr(tgt, 'target', None) or None) for tgt in _fin_targets(fin)], fin.parent is ast, fin)
+        for fin in fins])
+    merged = {} # index of statement -> {index of statement: [(target, move)]} merged into it
 
-    for fin in ast.find_all('FromImportNode'):
+    # In reverse so the statements split off one don't move the lines of the
+    # ones before it, and the targets merged into one are known when it's
+    # updated.
+    for i in reversed(range(len(fins))):
+        fin, plan = fins[i], plans[i]
         log.debug("  Processing statement: %s", fin)
 
-        absfrm = abs_mod_path(path, fin.value.dumps())
-        log.debug("    Absolute path %s", absfrm)
+        if stats:
+            stats.imports += 1
+        if not plan and i not in merged:
+            continue
+        if report is not None:
+            old_stmt, line = fin.dumps(), node_line(fin)
+            applied = [plan.move] + [tplan.move for tplan in plan.targets if tplan] if plan else []
 
-        assert len(moves) == 1 # haven't fully implemented multiple moves at once
-        new_fin = None
+        parens = len(fin.targets) != len(_fin_targets(fin))
+        appended = []
+        for source in sorted(merged.pop(i, {}).items()):
+            for tgt, move in source[1]:
+                appended.append(tgt)
+                if report is not None:
+                    applied.append(move)
+        if appended:
+            _set_fin_targets(fin, _fin_targets(fin) + appended, parens)
+        if not plan:
+            if report is not None:
+                report.append(_edit_record(line, old_stmt, fin.dumps(), applied))
+            continue
+
+        new_fins = OrderedDict() # new lhs -> new FromImportNode
         remove_targets = []
+        kept = _fin_targets(fin)
+
+        for tgt, tplan in zip(_fin_targets(fin), plan.targets):
+            if not tplan:
+                continue
+            edits += 1
+            # Update targets (the rhs / imports) before the value (lhs /
+            # from) because the latter might move the target to a new
+            # FromImportNode and should take this edit along with it.
+            if tplan.name:
+                tgt.value = tplan.name
+                if tplan.target:
+                    tgt.target = tplan.target
+                log.debug("        Updated target/rhs/import: %r", fin)
+            if tplan.duplicate:
+                remove_targets.append(tgt)
+                log.debug("        Prepped for dropping this since it's already imported")
+            elif tplan.merge is not None:
+                merged.setdefault(tplan.merge, {}).setdefault(i, []).append((tgt.copy(), tplan.move))
+                remove_targets.append(tgt)
+                log.debug("        Prepped for merging this into an existing from/import node")
+            elif tplan.module:
+                # Move this import to a new FromImportNode because this
+                # one may have other imports that shouldn't be moved.
+                if tplan.module not in new_fins:
+                    new_fins[tplan.module] = _from_import_node(tplan.module, tgt)
+                else:
+                    new_fins[tplan.module].targets.append(tgt.copy())
+                remove_targets.append(tgt)
+                log.debug("        Prepped for moving this to a new from/import node")
 
-        for tgt in fin.targets:
-            log.debug("    Processing subimport from %s import %s", absfrm, tgt)
-
-            for old, new in moves:
-                log.debug("      Processing move %s -> %s for 'from' and 'from/import' updates", old.full, new.full)
-                if absfrm == old.except_last and tgt.value == old.last:
-                    # eg for move a.b.c -> foo.bar, old.except_last == 'a.b' and old.last = 'c'
-
-                    # Update targets (the rhs / imports) before the value (lhs /
-                    # from) because the latter might move the target to a new
-                    # FromImportNode and should take this edit along with it.
-                    if tgt.value != new.last:
-                        tgt.value = new.last
-                        if not tgt.target:
-                            tgt.target = old.last
-                        log.debug("        Updated target/rhs/import: %r", fin)
-                    if absfrm != new.except_last:
-                        # fin.value = new.except_last # original too-simple version
-                        # Move this import to a new FromImportNode because this
-                        # one may have other imports that shouldn't be moved.
-                        if not new_fin:
-                            new_fin = RedBaron('from %s import %s' % (new.except_last, tgt.dumps()))[0]
-                        else:
-                            new_fin.targets.append(tgt.copy())
-                        # I don't know if it's safe to delete while iterating over the targets so hackily mark if for deletion later
-                        # tgt.value = 'this_was_moved_and_should_be_deleted'
-                        remove_targets.append(tgt)
-                        log.debug("        Prepped for moving this to a new from/import node")
-                # if absfrm == any warning paths heads and import is tail
-                #     warn
-                # if absfrm startswith any warning paths
-                #     warn
-
-        if new_fin:
+        if remove_targets:
             # TODO might be cool to move any CommentNodes after fin to above it,
             # since they might apply to fin or might apply to new_fin.
             node = fin
-            while node.next and type(node.next) == CommentNode:
+            while node.next and type(node.next) == redbaron().CommentNode:
                 node = node.next
-            node.insert_after(new_fin)
-            for t in remove_targets:
-                fin.targets.remove(t)
-            if len(fin.targets) == 0:
-                fin.parent.remove(fin)
-            log.debug("    Updated value/lhs/from, resulting in a new statement: %r and %r", fin, new_fin)
+            for new_fin in reversed(list(new_fins.values())):
+                node.insert_after(new_fin)
+            kept = [tgt for tgt in _fin_targets(fin) if tgt not in remove_targets]
+            if not kept:
+                _remove_statement(fin)
+            else:
+                _set_fin_targets(fin, kept, parens)
+            log.debug("    Updated value/lhs/from, resulting in new statements: %r and %r", fin, list(new_fins.values()))
 
         # Updates that only touch lhs of from imports (from part).
-        for old, new in moves:
-            log.debug("    Processing move %s -> %s for 'from'-only updates", old.full, new.full)
-            # TODO error on multiple matches
-            if absfrm.startswith(old.full):
-                # replace_import(fin.value, new.full + absfrm[len(old.full):])
-                fin.value = new.full + absfrm[len(old.full):]
-                # TODO split from because there might be existing ones.
-                log.debug("      Updated from from/value: %s", fin)
+        if plan.move and kept:
+            # replace_import(fin.value, plan.module)
+            fin.value = plan.module
+            edits += 1
+            log.debug("      Updated from from/value: %s", fin)
+
+        if report is not None:
+            new_stmts = [fin.dumps()] if kept else []
+            report.append(_edit_record(line, old_stmt, '\n'.join(new_stmts + [n.dumps() for n in new_fins.values()]), applied))
+
+    if report is not None:
+        report[reported:] = sorted(report[reported:], key=lambda record: record['line'])
+    return edits
+
+
+def _from_import_node(module, target):
+    """Return a new RedBaron FromImportNode importing target (a copy of it)
+    from module, built directly rather than by parsing its source since that's
+    much slower."""
+    value = []
+    for name in module.split('.'):
+        if value:
+            value.append({'type': 'dot', 'first_formatting': [], 'second_formatting': []})
+        value.append({'type': 'name', 'value': name})
+    space = [{'type': 'space', 'value': ' '}]
+    return redbaron().Node.from_fst({'type': 'from_import', 'value': value, 'targets': [target.fst()],
+                          'first_formatting': space, 'second_formatting': space, 'third_formatting': space})
+
+
+def update_imports_code(path, code, moves, nodes=None, stats=None, report=None, import_only=False):
+    """Update imports in code, the source of the file at path, using the
+    stdlib ast and tokenize modules instead of RedBaron, which is much faster
+    and lighter. Only the parts of import statements that change are edited,
+    so everything else is left exactly as it was. nodes can be the result of
+    find_import_nodes(code) if that's already been called. Returns the new code
+    and the number of imports updated. If stats (a Stats) is given, the number
+    of imports examined is added to it, and if report (a list) is given, a
+    record of each statement or reference updated is appended to it (see
+    update_imports_file()). If import_only is true, nodes are from
+    scan_import_nodes() and the rest of code is never parsed, so dotted
+    references to moved plain imports aren't updated; that's logged instead.
+    Raises SyntaxError if the stdlib can't parse code, eg if it's Python 2."""
+    log.debug("Processing file %s", path)
+    if not isinstance(moves, MoveIndex):
+        moves = MoveIndex(moves)
+    if nodes is None:
+        nodes = find_import_nodes(code)
+    lines = _SourceLines(code)
+    edits = []
+    count = 0
+    bindings = Bindings()
+    statements = [] # (node, its edits, moves applied)
+    reported = len(report) if report is not None else 0
+
+    from_nodes = [node for node in nodes if isinstance(node, pyast.ImportFrom)]
+    from_plans = plan_from_imports(path, moves, [
+        (abs_mod_path(path, '.' * node.level + (node.module or '')), [(alias.name, alias.asname) for alias in node.names],
+         node.col_offset == 0, node)
+        for node in from_nodes])
+    from_plans = iter(from_plans)
+    merge_points = [] # (statement, index of its last target once updated) for each in from_nodes
+
+    for node in nodes:
+        log.debug("  Processing statement on line %d", node.lineno)
+        if stats:
+            stats.imports += 1
+        stmt_edits = []
+        applied = []
+        statements.append((node, stmt_edits, applied))
+        if isinstance(node, pyast.Import):
+            _, names, name_ends = _import_tokens(lines, node)
+            for alias, (start, end), end in zip(node.names, names, name_ends):
+                plan = plan_import(moves, abs_mod_path(path, alias.name), alias.asname)
+                bindings.add(alias.name, alias.asname, plan)
+                if not plan:
+                    continue
+                stmt_edits.append((start, end, plan.name + (' as ' + plan.target if plan.target else '')))
+                applied.append(plan.move)
+                count += 1
+            continue
+
+        plan = next(from_plans)
+        merge_points.append((statements[-1], -1))
+        if not plan:
+            continue
+        applied.extend([plan.move] + [tplan.move for tplan in plan.targets if tplan])
+        module_span, targets, _ = _import_tokens(lines, node)
+
+        new_stmts = OrderedDict() # new lhs -> list of targets
+        kept = []
+        for i, (alias, tplan, (start, end)) in enumerate(zip(node.names, plan.targets, targets)):
+            if not tplan:
+                kept.append(i)
+                continue
+            count += 1
+            name = tplan.name or alias.name
+            text = name + (' as %s' % (alias.asname or tplan.target) if alias.asname or tplan.target else '')
+            if tplan.duplicate:
+                continue
+            if tplan.merge is not None:
+                (merge_node, merge_edits, merge_applied), last = merge_points[tplan.merge]
+                offset = _import_tokens(lines, merge_node)[1][last][1]
+                merge_edits.append((offset, offset, ', ' + text))
+                merge_applied.append(tplan.move)
+            elif tplan.module:
+                new_stmts.setdefault(tplan.module, []).append(text)
+            else:
+                stmt_edits.append((start, end, text))
+                kept.append(i)
+        if kept:
+            merge_points[-1] = (statements[-1], kept[-1])
+
+        if kept and plan.move:
+            stmt_edits.append(module_span + (plan.module,))
+            count += 1
+        new_stmts = ['from %s import %s' % (module, ', '.join(texts)) for module, texts in new_stmts.items()]
+        if len(kept) == len(targets):
+            continue
+
+        # Remove the moved targets along with the separators after them, or for
+        # ones after the last kept target, the separators before them.
+        last_kept = kept[-1] if kept else None
+        for i, (start, end) in enumerate(targets):
+            if i in kept:
+                continue
+            if last_kept is None:
+                break
+            if i < last_kept:
+                stmt_edits.append((start, targets[i + 1][0], ''))
+            else:
+                stmt_edits.append((targets[last_kept][1], targets[-1][1], ''))
+                break
+        if new_stmts:
+            stmt_edits.extend(_statement_insertion(lines, node, new_stmts, replace=not kept))
+        elif not kept:
+            stmt_edits.extend(_statement_removal(lines, node))
+
+    for node, stmt_edits, applied in statements:
+        edits.extend(stmt_edits)
+        if report is not None and stmt_edits:
+            report.append(_edit_record(node.lineno, *_apply_edits(code, [lines.node_span(node)] + stmt_edits), applied))
+
+    if bindings.rebound and import_only:
+        log.warning("%s: not updating references to %s since only the imports of files this big are parsed; you'll need to check them by hand",
+                    path, ', '.join(sorted(bindings.rebound)))
+    elif bindings.rebound:
+        # Only files with moved plain imports need the whole tree, so it's
+        # parsed again here rather than kept around for every file.
+        references = _reference_edits(path, lines, pyast.parse(code), moves, bindings, report)
+        edits.extend(references)
+        count += len(references)
+        if report is not None:
+            report[reported:] = sorted(report[reported:], key=lambda record: record['line'])
+
+    if not edits:
+        return code, 0
+    edits.sort()
+    chunks = []
+    pos = len(code)
+    for start, end, text in reversed(edits):
+        chunks.append(code[end:pos])
+        chunks.append(text)
+        pos = start
+    chunks.append(code[:pos])
+    return ''.join(reversed(chunks)), count
+
+
+def find_import_nodes(code):
+    """Parse code with the stdlib ast module and return its Import and
+    ImportFrom nodes, at any depth, in source order."""
+    nodes = [node for node in pyast.walk(pyast.parse(code)) if isinstance(node, (pyast.Import, pyast.ImportFrom))]
+    nodes.sort(key=lambda node: (node.lineno, node.col_offset))
+    return nodes
+
+
+def _redbaron_bound_names(target):
+    """Return the names bound by assigning to target, a RedBaron node like
+    the target of an assignment or a for loop, or None."""
+    if target is None:
+        return []
+    if target.type == 'name':
+        return [target.value]
+    if target.type in ('tuple', 'list'):
+        return [name for node in target.value for name in _redbaron_bound_names(node)]
+    if target.type == 'associative_parenthesis':
+        return _redbaron_bound_names(target.value)
+    return []
+
+
+def _reference_edits(path, lines, tree, moves, bindings, report=None):
+    """Return edits updating the dotted references like pkg.mod.func in tree
+    that bindings (a Bindings) says need updating, appending a record of each
+    to report if it's given. The names tree binds other than by imports are
+    added to bindings' shadowed in the same walk."""
+    inner = set()
+    attrs = []
+    for node in pyast.walk(tree):
+        if isinstance(node, pyast.Attribute):
+            attrs.append(node)
+            if isinstance(node.value, pyast.Attribute):
+                inner.add(node.value)
+        elif isinstance(node, pyast.Name) and isinstance(node.ctx, pyast.Store):
+            bindings.shadowed.add(node.id)
+        elif isinstance(node, pyast.arg):
+            bindings.shadowed.add(node.arg)
+        elif isinstance(node, (pyast.FunctionDef, pyast.AsyncFunctionDef, pyast.ClassDef)):
+            bindings.shadowed.add(node.name)
+        elif isinstance(node, pyast.ExceptHandler) and node.name:
+            bindings.shadowed.add(node.name)
+    edits = []
+    for node in attrs:
+        if node in inner:
+            continue
+        chain = []
+        while isinstance(node, pyast.Attribute):
+            chain.append(node)
+            node = node.value
+        if not isinstance(node, pyast.Name):
+            continue
+        chain.append(node)
+        chain.reverse()
+        name = '.'.join([node.id] + [attr.attr for attr in chain[1:]])
+        plan = bindings.plan(moves, name, path, node.lineno)
+        if plan:
+            move, count = plan
+            edits.append((lines.node_span(node)[0], lines.node_span(chain[count - 1])[1], move[1].full))
+            if report is not None:
+                report.append(_edit_record(node.lineno, '.'.join(name.split('.')[:count]), move[1].full, [move]))
+    return edits
+
+
+def _apply_edits(code, edits):
+    """Return the old and new code, stripped, of the part of code covered by
+    edits, a list of (start, end, text) where text replaces code[start:end],
+    or just (start, end) to only cover it."""
+    start = min(edit[0] for edit in edits)
+    end = max(edit[1] for edit in edits)
+    chunks = []
+    pos = start
+    for edit in sorted(edit for edit in edits if len(edit) == 3):
+        chunks.append(code[pos:edit[0]])
+        chunks.append(edit[2])
+        pos = edit[1]
+    chunks.append(code[pos:end])
+    return code[start:end].strip(), ''.join(chunks).strip()
+
+
+def _edit_record(line, old, new, moves):
+    """Return a report record of an edit on line from old to new code made by
+    moves, a list of (old, new) ModPath pairs or Nones."""
+    applied = []
+    for move in moves:
+        if move and [move[0].full, move[1].full] not in applied:
+            applied.append([move[0].full, move[1].full])
+    return {'line': line, 'old': old, 'new': new, 'moves': applied}
+
+
+def scan_import_nodes(code):
+    """Like find_import_nodes(), but find the import statements by tokenizing
+    code and only parse those, so memory use doesn't grow with the size of
+    the rest of the file."""
+    lines = _SourceLines(code)
+    nodes = []
+    depth = 0
+    stmt_start = True # whether the next token starts a statement
+    start = None # position of the import statement the tokens are in
+    for tok in _generate_tokens(code):
+        if tok.type in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT):
+            continue
+        if tok.type == tokenize.OP and tok.string in '([{':
+            depth += 1
+        elif tok.type == tokenize.OP and tok.string in ')]}':
+            depth -= 1
+        end = tok.type in (tokenize.NEWLINE, tokenize.ENDMARKER) or (depth == 0 and tok.type == tokenize.OP and tok.string in (';', ':'))
+        if start and end:
+            row, col = start
+            node = pyast.parse(code[lines.offset(row, col):lines.offset(*tok.start)]).body[0]
+            col = len(lines.lines[row - 1][:col].encode('utf-8'))
+            for n in pyast.walk(node):
+                if getattr(n, 'lineno', None) is None:
+                    continue
+                if n.lineno == 1:
+                    n.col_offset += col
+                if n.end_lineno == 1:
+                    n.end_col_offset += col
+                n.lineno += row - 1
+                n.end_lineno += row - 1
+            nodes.append(node)
+            start = None
+        elif stmt_start and tok.type == tokenize.NAME and tok.string in ('import', 'from'):
+            start = tok.start
+        stmt_start = end
+    return nodes
+
+
+def _generate_tokens(code):
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(code).readline):
+            yield tok
+    except tokenize.TokenError as e:
+        raise SyntaxError(str(e))
+
+
+class _SourceLines(object):
+    """Lines of code, split the same way tokenize splits them, for converting
+    between (line, column) positions and offsets into code."""
+
+    def __init__(self, code):
+        self.code = code
+        self.lines = io.StringIO(code).readlines()
+        self.starts = [0]
+        for line in self.lines:
+            self.starts.append(self.starts[-1] + len(line))
+
+    def offset(self, lineno, col, utf8=False):
+        """Return the offset in code of column col of line lineno (1-based).
+        Columns from the ast module count UTF-8 bytes, so pass utf8=True for
+        those."""
+        line = self.lines[lineno - 1] if lineno <= len(self.lines) else ''
+        if utf8 and not line.isascii():
+            col = len(line.encode('utf-8')[:col].decode('utf-8', 'replace'))
+        return self.starts[lineno - 1] + col
+
+    def node_span(self, node):
+        return (self.offset(node.lineno, node.col_offset, utf8=True),
+                self.offset(node.end_lineno, node.end_col_offset, utf8=True))
+
+    def line_span(self, offset):
+        """Return the offsets of the start and end (including any newline) of
+        the line containing offset."""
+        i = bisect.bisect_right(self.starts, offset) - 1
+        i = min(i, len(self.lines) - 1)
+        return self.starts[i], self.starts[i + 1]
+
+
+def _import_tokens(lines, node):
+    """Tokenize the import statement node and return the span (start and end
+    offsets) of the module in a from import (None for plain imports), a list
+    of the spans of each imported name including any 'as' part, and a list of
+    the end offsets of each imported name without the 'as' part."""
+    start, end = lines.node_span(node)
+    base_line = bisect.bisect_right(lines.starts, start) - 1
+    text = lines.code[start:lines.line_span(end - 1)[1]]
+
+    def offset(pos):
+        row, col = pos
+        if row == 1:
+            return start + col
+        return lines.starts[base_line + row - 1] + col
+
+    toks = []
+    for tok in tokenize.generate_tokens(io.StringIO(text).readline):
+        if offset(tok.start) >= end:
+            break
+        if tok.type not in (tokenize.NL, tokenize.COMMENT):
+            toks.append((tok.string, offset(tok.start), offset(tok.end)))
+
+    i = 1
+    module = None
+    if toks[0][0] == 'from':
+        while toks[i][0] != 'import':
+            i += 1
+        module = (toks[1][1], toks[i - 1][2])
+        i += 1
+    names = []
+    name_start = None
+    for string, tok_start, tok_end in toks[i:]:
+        if string == ',':
+            names.append((name_start, name_end, name_stop))
+            name_start = None
+        elif string == 'as':
+            aliased = True
+        elif string not in ('(', ')'):
+            if name_start is None:
+                name_start, aliased = tok_start, False
+            if not aliased:
+                name_end = tok_end
+            name_stop = tok_end
+    if name_start is not None:
+        names.append((name_start, name_end, name_stop))
+    return module, [(start, end) for start, name_end, end in names], [name_end for start, name_end, end in names]
+
+
+def _statement_insertion(lines, node, new_stmts, replace):
+    """Return the edits that add new_stmts after the statement node, or in its
+    place if replace is true. They go on their own lines at the same indent,
+    unless the statement shares a line with other code, in which case they're
+    added to it with semicolons."""
+    start, end = lines.node_span(node)
+    line_start, _ = lines.line_span(start)
+    _, line_end = lines.line_span(end - 1)
+    indent = lines.code[line_start:start]
+    rest = lines.code[end:line_end]
+    last_line = lines.code[lines.line_span(end - 1)[0]:line_end]
+    nl = '\r\n' if last_line.endswith('\r\n') else '\n'
+    missing_nl = not last_line.endswith('\n')
+
+    if indent.strip() or (rest.strip() and not rest.strip().startswith('#')):
+        if replace:
+            return [(start, end, '; '.join(new_stmts))]
+        return [(end, end, ''.join('; ' + stmt for stmt in new_stmts))]
+    edits = []
+    if replace:
+        edits.append((start, end, (nl + indent).join(new_stmts)))
+        if missing_nl:
+            edits.append((line_end, line_end, nl))
+    else:
+        edits.append((line_end, line_end, (nl if missing_nl else '') + ''.join(indent + stmt + nl for stmt in new_stmts)))
+    return edits
+
+
+def _statement_removal(lines, node):
+    """Return the edits that remove the statement node, along with its line
+    unless it shares it with other code."""
+    start, end = lines.node_span(node)
+    line_start, _ = lines.line_span(start)
+    _, line_end = lines.line_span(end - 1)
+    before = lines.code[line_start:start]
+    rest = lines.code[end:line_end]
+    if before.strip() or (rest.strip() and not rest.strip().startswith('#')):
+        after = re.match(r'\s*;[ \t]*', rest)
+        if after:
+            return [(start, end + after.end(), '')]
+        return [(line_start + re.search(r'\s*;\s*$', before).start(), end, '')]
+    return [(line_start, line_end, '')]
+
+
+class Bindings(object):
+    """Names bound by a file's plain imports without 'as', for updating
+    dotted references like pkg.mod.func when those imports are moved (eg
+    after 'import pkg.mod' becomes 'import pkg2.mod', pkg.mod.func needs to
+    become pkg2.mod.func). It's filled in while the imports are updated, so
+    the references can then be found in a single walk of the file's tree,
+    which also fills in shadowed. References whose first name is bound
+    anywhere in the file other than by an import, eg a parameter named like
+    the package, aren't updated since they may not refer to the import."""
+
+    def __init__(self):
+        self.rebound = set() # first names of plain imports that were moved
+        self.bound = set() # first names of plain imports once they're updated
+        self.shadowed = set() # names bound by assignments, parameters, defs etc
+        self.warned = set()
+
+    def add(self, name, target, plan):
+        """Note a plain subimport of name with 'as' name target (or None),
+        updated according to plan (an ImportPlan, or None)."""
+        if target or (plan and plan.target):
+            # references use the 'as' name, which stays the same
+            return
+        self.bound.add((plan.name if plan else name).split('.')[0])
+        if plan:
+            self.rebound.add(name.split('.')[0])
+
+    def plan(self, moves, name, path, line):
+        """Work out how moves (a MoveIndex) update the dotted reference name on
+        line of the file at path. Returns None if they don't, or the (old, new)
+        move that does and how many of the dotted parts of name it replaces."""
+        if name.split('.')[0] not in self.rebound:
+            return None
+        if name.split('.')[0] in self.shadowed:
+            if moves.find(name) and name not in self.warned:
+                self.warned.add(name)
+                log.warning("%s:%d: can't update %s since %s is also bound by something other than an import; you'll need to update it by hand",
+                            path, line, name, name.split('.')[0])
+            return None
+        move = moves.find(name)
+        if move:
+            old, new = move
+            if new.full.split('.')[0] in self.bound:
+                return move, old.full.count('.') + 1
+        elif name.split('.')[0] in self.bound:
+            return None
+        if name not in self.warned:
+            self.warned.add(name)
+            log.warning("%s:%d: can't update %s since what it refers to isn't imported once imports are moved; you'll need to update it by hand",
+                        path, line, name)
+        return None
+
+
+ImportPlan = namedtuple('ImportPlan', ['move', 'name', 'target'])
+FromImportPlan = namedtuple('FromImportPlan', ['move', 'module', 'targets'])
+TargetPlan = namedtuple('TargetPlan', ['move', 'name', 'target', 'module', 'merge', 'duplicate'], defaults=[None, False])
+
+
+def plan_import(moves, absfrm, target):
+    """Work out how moves (a MoveIndex) update the subimport absfrm of a plain
+    import, which has 'as' name target (or None). Returns None if none applies,
+    or an ImportPlan of the move applied, the new dotted name, and the 'as'
+    name to add (or None)."""
+    log.debug("      Absolute path %s", absfrm)
+
+    move = moves.find(absfrm)
+    if not move:
+        _warn_reexport(moves, absfrm, "import %s" % absfrm)
+        return None
+    old, new = move
+    log.debug("      Applying move %s -> %s for 'import' updates", old.full, new.full)
+    add_target = None
+    # if tail was changed and stmt.value == oldpath and as is None
+    if absfrm == old.full and not target:
+        if '.' not in absfrm:
+            add_target = absfrm
+        else:
+            log.debug("Warning: updating 'import %s' to 'import %s'; you'll nned to any references to %s", old.full, new.full, old.full)
+    return ImportPlan(move, new.full + absfrm[len(old.full):], add_target)
+
+
+def plan_from_import(moves, absfrm, targets):
+    """Work out how moves (a MoveIndex) update 'from absfrm import targets',
+    where absfrm is absolute and targets is a list of (name, 'as' name or
+    None). Returns None if none applies, or a FromImportPlan of the move
+    applied to absfrm itself (or None) with the resulting module, and a list
+    with a TargetPlan or None for each target. A TargetPlan has the move
+    applied to the target, its new name (None if unchanged), the 'as' name to
+    add (or None), and the module to move it to a new statement for (None if
+    it stays in this one)."""
+    log.debug("    Absolute path %s", absfrm)
+
+    # The move that only touches the lhs of from imports (from part). It's
+    # applied last but needed up front to know which targets stay here.
+    frm_move = moves.find(absfrm)
+    newfrm = absfrm
+    if frm_move:
+        log.debug("    Applying move %s -> %s for 'from'-only updates", frm_move[0].full, frm_move[1].full)
+        newfrm = frm_move[1].full + absfrm[len(frm_move[0].full):]
+
+    tplans = []
+    for name, target in targets:
+        log.debug("    Processing subimport from %s import %s", absfrm, name)
+        tplans.append(None)
+
+        move = moves.find(absfrm + '.' + name)
+        if not move or move[0].full != absfrm + '.' + name:
+            if not frm_move:
+                _warn_reexport(moves, absfrm + '.' + name, "from %s import %s" % (absfrm, name))
+            continue
+        old, new = move
+        log.debug("      Applying move %s -> %s for 'from' and 'from/import' updates", old.full, new.full)
+        # eg for move a.b.c -> foo.bar, old.except_last == 'a.b' and old.last = 'c'
+        if not new.except_last:
+            log.warning("Can't update 'from %s import %s' for move to top level %s", absfrm, name, new.full)
+            continue
+        new_name = add_target = module = None
+        if name != new.last:
+            new_name = new.last
+            if not target:
+                add_target = old.last
+        if newfrm != new.except_last:
+            module = new.except_last
+        tplans[-1] = TargetPlan(move, new_name, add_target, module)
+
+    if not frm_move and not any(tplans):
+        return None
+    return FromImportPlan(frm_move, newfrm, tplans)
+
+
+def plan_from_imports(path, moves, statements):
+    """Work out how moves (a MoveIndex) update all the from imports of the file
+    at path. statements is a list of (absfrm, targets, top, node) for each in
+    source order, with absfrm and targets as for plan_from_import(), top
+    whether it's at the top level of the file and node its statement. Returns
+    a list of the plan_from_import() result for each, except that targets
+    moved to a module an earlier top level statement already imports from are
+    merged into it (their TargetPlan.merge is its index), and targets that
+    would then be imported twice are dropped (TargetPlan.duplicate). Only top
+    level statements are merged, so the targets stay in the same scope and
+    are imported no later than they were."""
+    plans = []
+    existing = {} # module once updated -> (index of statement, names it imports)
+    for i, (absfrm, targets, top, node) in enumerate(statements):
+        plan = plan_from_import(moves, absfrm, targets)
+        plans.append(plan)
+        tplans = plan.targets if plan else [None] * len(targets)
+        names = set(target for target, tplan in zip(targets, tplans) if not tplan)
+        for j, ((name, asname), tplan) in enumerate(zip(targets, tplans)):
+            if not tplan:
+                continue
+            new = (tplan.name or name, asname or tplan.target)
+            if not tplan.module:
+                if _already_imported(names, new, tplan.target, path, node):
+                    tplans[j] = tplan._replace(duplicate=True)
+            elif top and tplan.module in existing:
+                index, merge_names = existing[tplan.module]
+                tplans[j] = tplan._replace(merge=index, duplicate=_already_imported(merge_names, new, tplan.target, path, node))
+        module = plan.module if plan else absfrm
+        if top and names and module not in existing and ('*', None) not in names:
+            existing[module] = (i, names)
+    return plans
+
+
+def _already_imported(names, target, added, path, node):
+    """Return whether target, a (name, 'as' name) pair, is already imported by
+    a statement importing names (a set of pairs), or else add it to them. A
+    target whose 'as' name was only added to keep its old name (added) counts
+    as imported if its name is, with a warning since its old name is lost."""
+    if target in names:
+        return True
+    name, asname = target
+    if added and (name, None) in names:
+        log.warning("%s:%d: %s is already imported, so it's no longer imported as %s too; you'll need to update references to %s by hand",
+                    path, node_line(node), name, asname, asname)
+        return True
+    names.add(target)
+    return False
+
+
+def _warn_reexport(moves, name, stmt):
+    """Warn if name is something moved that's imported through a parent that
+    re-exports it, since those imports are left as they are."""
+    found = moves.find_reexport(name)
+    if found:
+        reexport, (old, new) = found
+        log.warning("'%s' imports %s through %s, which re-exports it; it's left as is, so make sure %s still does once it's moved to %s",
+                    stmt, old.full, reexport.rpartition('.')[0], reexport.rpartition('.')[0], new.full)
 
 
 def abs_mod_path(from_file, imp):
@@ -214,10 +2898,9 @@ def abs_mod_path(from_file, imp):
 
     if from_file.startswith('./'):
         from_file = from_file[2:]
-    if from_file.endswith('/__init__.py'):
-        mod = from_file.replace('/', '.')[:-12]
-    else:
-        mod = from_file.replace('/', '.')[:-3]
+    # A package's __init__.py is treated like a module in the package, since
+    # relative imports in it are relative to the package itself.
+    mod = from_file.replace('/', '.')[:-3]
 
     if imp[0] != '.':
         return imp